@@ -5,6 +5,8 @@ from .album import *
 from .artist import *
 from .song import *
 from .track import *
+from .catalog import *
+from .job import *
 
 def register():
     Pool.register(
@@ -14,13 +16,26 @@ def register():
         Artist,
         Song,
         Track,
+        CatalogDeletion,
+        Catalog,
         ExportTracksStart,
         ExportTracksResult,
+        ExportTracksQueued,
+        ImportTracksStart,
+        ImportTracksResult,
+        RebuildCatalogStart,
+        CheckStatisticsStart,
+        ExportJob,
+        ExportJobSongbook,
         module='songbook', type_='model')
     Pool.register(
         ExportTracks,
+        ImportTracks,
+        RebuildCatalog,
+        CheckStatistics,
         module='songbook', type_='wizard')
     Pool.register(
         SongbookByArtist,
+        SongbookByTitle,
         module='songbook', type_='report')
 
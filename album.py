@@ -1,10 +1,18 @@
+from hashlib import md5
+
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.cache import Cache
+from werkzeug.http import is_resource_modified
 from nereid import (
     request, abort, render_template, login_required, url_for, flash, jsonify,
     current_app, route
 )
 
+from .profiling import profiled
+from .responsecache import response_cache
+
 __all__ = ['Album']
 
 
@@ -12,16 +20,20 @@ class Album(ModelSQL, ModelView):
     "Album"
     __name__ = "songbook.album"
 
-    songbook = fields.Many2One("songbook.songbook", 'Songbook', required=True)
+    songbook = fields.Many2One("songbook.songbook", 'Songbook', required=True,
+        select=True)
     code = fields.Char('Code', 16, required=True, select=True)
     name = fields.Char('Name', 64, required=True, select=True)
-    publisher = fields.Many2One("songbook.publisher", 'Publisher', required=True)
+    publisher = fields.Many2One("songbook.publisher", 'Publisher',
+        required=True, select=True)
     description = fields.Text('Description')
     tracks = fields.One2Many(
         "songbook.track",
         'album',
         'Tracks in This Album'
     )
+    _songlist_cache = Cache('songbook.album.songlist', size_limit=256,
+        context=False)
 
     @classmethod
     def __setup__(cls):
@@ -33,15 +45,85 @@ class Album(ModelSQL, ModelView):
         cls._order.insert(0, ('songbook', 'ASC'))
         cls._order.insert(1, ('code', 'ASC'))
 
+    @classmethod
+    def create(cls, vlist):
+        Catalog = Pool().get('songbook.catalog')
+        albums = super(Album, cls).create(vlist)
+        Catalog.update_album_counts([a.songbook.id for a in albums],
+            [a.publisher.id for a in albums])
+        response_cache.clear()
+        return albums
+
+    @classmethod
+    def write(cls, albums, values):
+        Catalog = Pool().get('songbook.catalog')
+        moved = 'songbook' in values or 'publisher' in values
+        if moved:
+            songbook_ids = [a.songbook.id for a in albums]
+            publisher_ids = [a.publisher.id for a in albums]
+        super(Album, cls).write(albums, values)
+        Catalog.refresh_for('album', [a.id for a in albums])
+        if moved:
+            albums = cls.browse([a.id for a in albums])
+            Catalog.update_album_counts(
+                songbook_ids + [a.songbook.id for a in albums],
+                publisher_ids + [a.publisher.id for a in albums])
+        response_cache.clear()
+
+    @classmethod
+    def delete(cls, albums):
+        Catalog = Pool().get('songbook.catalog')
+        songbook_ids = [a.songbook.id for a in albums]
+        publisher_ids = [a.publisher.id for a in albums]
+        super(Album, cls).delete(albums)
+        Catalog.update_album_counts(songbook_ids, publisher_ids)
+        response_cache.clear()
+
+    def get_fingerprint(self):
+        """
+        Return an ETag of the album content: its songbook and the catalog
+        version of the songbook, incremented under a lock of the songbook
+        row by every change of the tracks, songs, artists, publishers and
+        albums of its catalog, so it follows the commit order.
+        """
+        Songbook = Pool().get('songbook.songbook')
+        cursor = Transaction().cursor
+        album = self.__table__()
+        songbook = Songbook.__table__()
+        cursor.execute(*album.join(songbook,
+                condition=songbook.id == album.songbook
+                ).select(songbook.id, songbook.catalog_version,
+                where=album.id == self.id))
+        songbook_id, version = cursor.fetchone()
+        return md5('%s:%s:%s' % (self.id, songbook_id, version or 0)
+            ).hexdigest()
+
     @classmethod
     @route('/songbook/albums/<code>.txt', methods=['GET'])
+    @profiled
     def call_api_index(cls, code):
         """
         Delimited text file via website
         """
-        album=cls.search([('code', '=', code)])[0]
-        return render_template(
-            'songbook_songlist-txt.jinja',
-            tracks = album.tracks
-        )
+        albums = cls.search([('code', '=', code)], limit=1)
+        if not albums:
+            abort(404)
+        album, = albums
 
+        # No Last-Modified: the dates of the records are transaction start
+        # times and do not change when a track is removed
+        etag = album.get_fingerprint()
+        if not is_resource_modified(request.environ, etag=etag):
+            response = current_app.response_class(status=304)
+        else:
+            key = (album.id, etag, Transaction().language)
+            body = cls._songlist_cache.get(key)
+            if body is None:
+                body = unicode(render_template(
+                    'songbook_songlist-txt.jinja',
+                    tracks = album.tracks
+                ))
+                cls._songlist_cache.set(key, body)
+            response = current_app.response_class(body)
+        response.set_etag(etag)
+        return response
@@ -1,9 +1,11 @@
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond import backend
 
 from sql import Table, Column, Literal, Desc, Asc, Expression, Flavor
 from sql.functions import Now, Extract
-from sql.operators import Or, And, Concat, ILike, Operator
+from sql.operators import Or, And, Concat, ILike, In, Operator
 from sql.conditionals import Coalesce
 from sql.aggregate import Count, Max
 
@@ -14,6 +16,15 @@ from nereid import (
 from nereid.contrib.pagination import Pagination, BasePagination
 from nereid.ctx import has_request_context
 
+from .index import PrefixIndex
+from .pagination import KeysetPagination
+from .prefetch import prefetch
+from .profiling import profiled
+from .responsecache import (GenerationCache, response_cache,
+    cached_response)
+from .tools import (create_trigram_index, update_column, url_template,
+    sort_key, api_limit, api_ids, api_fields, project)
+
 __all__ = ['Artist']
 
 
@@ -24,10 +35,9 @@ class Artist(ModelSQL, ModelView):
 
     last_name = fields.Char('Last Name', required=True, select=True)
     first_name = fields.Char('First Name', select=True)
-    full_name = fields.Function(
-        fields.Char('Full Name'), 'get_full_name',
-        searcher='search_full_name'
-    )
+    full_name = fields.Char('Full Name', readonly=True, select=True,
+        on_change_with=['last_name', 'first_name'])
+    sort_name = fields.Char('Sort Name', readonly=True, select=True)
     rev_name = fields.Function(
         fields.Char('Reversed Name'), 'get_rev_name'
     )
@@ -36,23 +46,73 @@ class Artist(ModelSQL, ModelView):
         'artist',
         'Songs by This Artist'
     )
+    # Statistics maintained by the catalog
+    track_count = fields.Integer('Tracks', readonly=True)
+    song_count = fields.Integer('Songs with Tracks', readonly=True)
+    stats_date = fields.Timestamp('Statistics Changed', readonly=True)
+    _prefix_index = GenerationCache('songbook.artist.prefix_index',
+        size_limit=1)
+    # The keys of the API payloads which can be selected with fields=
+    _api_fields = ['url', 'lastName', 'firstName', 'fullName']
+    # The paths of the records shown by the detail page, read beforehand
+    _detail_prefetch = ['songs.tracks.album.songbook']
 
     def serialize(self):
         """
         Serialize the artist object and return a dictionary.
         """
-        object_json = {
-            "url": url_for(
-                'songbook.artist.render_html',
-                id=self.id,
-            ),
-            "objectType": self.__name__,
-            "id": self.id,
-            "lastName": self.last_name,
-            "firstName": self.first_name,
-            "fullName": self.full_name,
+        return self.serialize_many([self])[0]
+
+    @classmethod
+    def serialize_many(cls, artists, fields=None):
+        """
+        Serialize the artist objects and return a list of dictionaries
+        in the same order, skipping the artists that do not exist or that
+        the user may not read.
+        Besides objectType and id, only the keys of _api_fields in fields
+        (all when None) are read and returned.
+        """
+        ModelAccess = Pool().get('ir.model.access')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        ModelAccess.check(cls.__name__, 'read')
+        if fields is None:
+            fields = cls._api_fields
+        columns = {
+            'lastName': table.last_name,
+            'firstName': table.first_name,
+            'fullName': table.full_name,
         }
-        return object_json
+        names = [f for f in fields if f in columns]
+        ids = [a.id for a in artists]
+        values = {}
+        for i in range(0, len(ids), cursor.IN_MAX):
+            # Search to apply the record rules
+            sub_ids = [r.id for r in cls.search(
+                    [('id', 'in', ids[i:i + cursor.IN_MAX])], order=[])]
+            if not sub_ids:
+                continue
+            cursor.execute(*table.select(
+                    table.id, *[columns[n] for n in names],
+                    where=In(table.id, sub_ids)))
+            for row in cursor.fetchall():
+                values[row[0]] = dict(zip(names, row[1:]))
+        url = None
+        if 'url' in fields:
+            url = url_template('songbook.artist.render_html')
+        result = []
+        for artist in artists:
+            if artist.id not in values:
+                continue
+            payload = {
+                "objectType": cls.__name__,
+                "id": artist.id,
+            }
+            payload.update(values[artist.id])
+            if url:
+                payload['url'] = url % artist.id
+            result.append(payload)
+        return result
 
     @classmethod
     def __setup__(cls):
@@ -61,63 +121,226 @@ class Artist(ModelSQL, ModelView):
             ('name_uniq', 'UNIQUE(last_name, first_name)',
              'An artist with that name already exists.')
         ]
-        cls._order.insert(0, ('last_name', 'ASC'))
-        cls._order.insert(1, ('first_name', 'ASC'))
+        cls._order.insert(0, ('sort_name', 'ASC'))
+        cls._order.insert(1, ('last_name', 'ASC'))
+        cls._order.insert(2, ('first_name', 'ASC'))
+
+    @staticmethod
+    def default_track_count():
+        return 0
+
+    @staticmethod
+    def default_song_count():
+        return 0
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = TableHandler(cursor, cls, module_name)
+        sql_table = cls.__table__()
+
+        full_name_exist = table.column_exist('full_name')
+
+        super(Artist, cls).__register__(module_name)
+
+        # Migration from 3.0.1: full_name is stored
+        if not full_name_exist:
+            cursor.execute(*sql_table.select(
+                    sql_table.id, sql_table.last_name, sql_table.first_name))
+            update_column(cursor, sql_table, sql_table.full_name,
+                dict((id_, cls.format_full_name(last_name, first_name))
+                    for id_, last_name, first_name in cursor.fetchall()))
+
+        create_trigram_index(cursor, cls._table, 'full_name')
+        cls.update_sort_keys()
 
     @classmethod
-    def search_full_name(cls, name, clause):
-        "Search Full Name"
-        _, operator, value = clause
-        Operator = fields.SQL_OPERATORS[operator]
+    def update_sort_keys(cls):
+        "Recompute the sort names, after a change of the sort options"
+        cursor = Transaction().cursor
         table = cls.__table__()
-        fullname = Concat(
-            Coalesce(table.first_name, Literal('')),
-            Concat(
-                Literal(' '),
-                Coalesce(table.last_name, Literal(''))
-            )
-        )
+        cursor.execute(*table.select(table.id, table.last_name,
+                table.first_name, table.sort_name))
+        sort_names = {}
+        for id_, last_name, first_name, sort_name in cursor.fetchall():
+            new_sort_name = cls.format_sort_name(last_name, first_name)
+            if new_sort_name != sort_name:
+                sort_names[id_] = new_sort_name
+        update_column(cursor, table, table.sort_name, sort_names)
+
+    @classmethod
+    def update_names(cls, ids):
+        "Recompute the full and sort names of the artists"
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        full_names, sort_names = {}, {}
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(table.id, table.last_name,
+                    table.first_name, table.full_name, table.sort_name,
+                    where=In(table.id, sub_ids)))
+            for id_, last_name, first_name, full_name, sort_name in \
+                    cursor.fetchall():
+                new_full_name = cls.format_full_name(last_name, first_name)
+                if new_full_name != full_name:
+                    full_names[id_] = new_full_name
+                new_sort_name = cls.format_sort_name(last_name, first_name)
+                if new_sort_name != sort_name:
+                    sort_names[id_] = new_sort_name
+        update_column(cursor, table, table.full_name, full_names)
+        update_column(cursor, table, table.sort_name, sort_names)
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [x.copy() for x in vlist]
+        for values in vlist:
+            if values.get('last_name'):
+                values['full_name'] = cls.format_full_name(
+                    values['last_name'], values.get('first_name'))
+                values['sort_name'] = cls.format_sort_name(
+                    values['last_name'], values.get('first_name'))
+        artists = super(Artist, cls).create(vlist)
+        cls.clear_prefix_index()
+        response_cache.clear()
+        return artists
 
-        query = table.select(table.id, where=Operator(fullname, value))
-        return [('id', 'in', query)] 
+    @classmethod
+    def write(cls, artists, values):
+        Catalog = Pool().get('songbook.catalog')
+        super(Artist, cls).write(artists, values)
+        cls.clear_prefix_index()
+        if 'last_name' in values or 'first_name' in values:
+            cls.update_names([a.id for a in artists])
+        Catalog.refresh_for('artist', [a.id for a in artists])
+        response_cache.clear()
+
+    @classmethod
+    def delete(cls, artists):
+        super(Artist, cls).delete(artists)
+        cls.clear_prefix_index()
+        response_cache.clear()
 
-    def get_full_name(self, name):
-        if self.first_name is None:
-            fullname = self.last_name
+    @classmethod
+    def clear_prefix_index(cls):
+        "Invalidate the prefix indexes built on artist names"
+        Song = Pool().get('songbook.song')
+        cls._prefix_index.clear()
+        Song._prefix_index.clear()
+
+    @classmethod
+    def get_prefix_index(cls):
+        """
+        Return the prefix index of artist names, building it if needed.
+        Return None when the index is disabled or over its size limit.
+        """
+        if not PrefixIndex.enabled():
+            return None
+        index = cls._prefix_index.get('index')
+        if index is None:
+            generation = cls._prefix_index.generation()
+            cursor = Transaction().cursor
+            table = cls.__table__()
+            cursor.execute(*table.select(
+                    table.id, table.last_name, table.first_name,
+                    table.full_name,
+                    order_by=[
+                        Asc(table.sort_name), Asc(table.last_name),
+                        Asc(table.first_name), Asc(table.id)
+                    ]))
+            entries = (({
+                        "objectType": cls.__name__,
+                        "id": id_,
+                        "lastName": last_name,
+                        "firstName": first_name,
+                        "fullName": full_name,
+                        }, {'full_name': full_name})
+                for id_, last_name, first_name, full_name
+                in cursor.fetchall())
+            index = PrefixIndex.build(entries) or False
+            cls._prefix_index.set('index', index, generation)
+        return index or None
+
+    @staticmethod
+    def format_full_name(last_name, first_name):
+        if first_name is None:
+            fullname = last_name
         else:
-            fullname = "%s %s" % (self.first_name, self.last_name) 
+            fullname = "%s %s" % (first_name, last_name)
         return fullname.strip(" ")
 
-    def get_rev_name(self, name):
-        if self.first_name is None:
-            revname = self.last_name
+    @staticmethod
+    def format_rev_name(last_name, first_name):
+        if first_name is None:
+            revname = last_name
         else:
-            revname = "%s, %s" % (self.last_name, self.first_name) 
+            revname = "%s, %s" % (last_name, first_name)
         return revname.strip(", ")
 
+    @staticmethod
+    def format_sort_name(last_name, first_name):
+        "Return the key ordering artists by last name then first name"
+        return u' '.join(k for k in [sort_key(last_name), sort_key(first_name)]
+            if k)
+
+    def on_change_with_full_name(self, name=None):
+        if self.last_name is None:
+            return None
+        return self.format_full_name(self.last_name, self.first_name)
+
+    def get_rev_name(self, name):
+        return self.format_rev_name(self.last_name, self.first_name)
+
     @classmethod
     @route('/songbook/api/artists', methods=['GET', 'POST'])
+    @profiled
+    @cached_response
     def call_api_index(cls):
         """
         JSON-formatted REST API to support 3rd party integration, apps
         and web page javascript such as search-as-you-type.
+        ids= returns the artists with these comma-separated ids instead and
+        fields= restricts the keys of the artists.
         """
+        limit = api_limit(5)
+        fields = api_fields(cls._api_fields)
+        ids = api_ids()
+        if ids is not None:
+            return jsonify(
+                artists=cls.serialize_many(cls.browse(ids), fields)
+            )
+
+        index = cls.get_prefix_index()
+        if index is not None:
+            payloads = index.search({
+                    'full_name': request.args.get('namecontains', ''),
+                    }, limit)
+            url = url_template('songbook.artist.render_html')
+            return jsonify(
+                artists=[project(dict(p, url=url % p['id']), fields)
+                    for p in payloads]
+            )
+
         name_filter = '%' + request.args.get('namecontains', '') + '%'
         domain = [
             ('full_name', 'ilike', name_filter)
         ]
-        artists = cls.search(domain, limit=int(request.args.get('limit', '5')))
+        artists = cls.search(domain, limit=limit)
         return jsonify(
-            artists=[a.serialize() for a in artists]
+            artists=cls.serialize_many(artists, fields)
         )
 
     @classmethod
     @route('/songbook/artists/<int:id>', methods=['GET'])
+    @profiled
     def render_html(cls, id=0):
         """
         output details of a selected artist to web client
         """
-        artist=cls.browse([id])[0]
+        artists = cls.search([('id', '=', id)])
+        if not artists:
+            abort(404)
+        artist, = prefetch(artists, cls._detail_prefetch)
         return render_template(
             'songbook_artist-detail.jinja',
             artist=artist
@@ -125,6 +348,8 @@ class Artist(ModelSQL, ModelView):
 
     @classmethod
     @route('/songbook/artists', methods=['GET', 'POST'])
+    @profiled
+    @cached_response
     def render_html_index(cls):
         """
         output artist list to web client
@@ -134,9 +359,16 @@ class Artist(ModelSQL, ModelView):
         domain = [
             ('full_name', 'ilike', name_filter)
         ]
-        artists = Pagination(
-            cls, domain, page, 25
-        )
+        if 'cursor' in request.args:
+            artists = KeysetPagination(
+                cls, domain, ['sort_name', 'full_name'], 25,
+                cursor=request.args.get('cursor'),
+                count=request.args.get('count', 0, int)
+            )
+        else:
+            artists = Pagination(
+                cls, domain, page, 25
+            )
 
         return render_template(
             'songbook_artist-list.jinja',
@@ -0,0 +1,9 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+"""
+Benchmarks of the songbook module on synthetic catalogs.
+
+Run with::
+
+    python -m trytond.modules.songbook.benchmark.run --output result.json
+"""
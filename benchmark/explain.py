@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+"""
+Check with EXPLAIN that the queries of the export, the reports and the
+getters use indexes on the large tables of a synthetic catalog.
+Exit with status 1 when one of them scans such a table sequentially.
+"""
+import optparse
+import re
+import sys
+
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+
+from ..profiling import QueryRecorder
+from .generator import DEFAULTS
+from .run import BENCHMARKS, catalog
+
+__all__ = ['CHECKED', 'sequential_scans', 'check', 'main']
+
+# The benchmarks whose queries are checked
+CHECKED = [
+    'export_tracks',
+    'songbook_by_artist.parse',
+    'songbook.songs_title',
+    'songbook.songs_artist',
+    'GET /songbook/albums/<code>.txt',
+]
+
+_ALIASES = re.compile(r'"(\w+)" AS "(\w+)"')
+_SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?$')
+_POSTGRESQL_SCAN = re.compile(r'Seq Scan on (\w+)')
+
+
+def sequential_scans(sql, params):
+    "Return the names of the tables the statement reads sequentially"
+    cursor = Transaction().cursor
+    if CONFIG['db_type'] == 'postgresql':
+        cursor.execute('EXPLAIN ' + sql, params)
+        return [t for r in cursor.fetchall()
+            for t in _POSTGRESQL_SCAN.findall(r[0])]
+
+    aliases = dict((a, t) for t, a in _ALIASES.findall(sql))
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params or ())
+    tables = []
+    for row in cursor.fetchall():
+        match = _SQLITE_SCAN.match(row[-1])
+        if match:
+            name = match.group(2) or match.group(1)
+            tables.append(aliases.get(name, name))
+    return tables
+
+
+def _size(table):
+    cursor = Transaction().cursor
+    cursor.execute('SELECT COUNT(*) FROM "%s"' % table)
+    return cursor.fetchone()[0]
+
+
+def check(context, min_rows):
+    """
+    Run the checked benchmarks and return the (benchmark, table, statement)
+    of the sequential scans of the module tables with more than min_rows
+    rows.
+    """
+    sizes = {}
+    failures = []
+    for name, func in BENCHMARKS:
+        if name not in CHECKED:
+            continue
+        with QueryRecorder(name, keep=True) as recorder:
+            func(context)
+        seen = set()
+        for sql, params in recorder.statements:
+            if not sql.lstrip().upper().startswith('SELECT') or sql in seen:
+                continue
+            seen.add(sql)
+            for table in sequential_scans(sql, params):
+                if not table.startswith('songbook_'):
+                    continue
+                if table not in sizes:
+                    sizes[table] = _size(table)
+                if sizes[table] > min_rows:
+                    failures.append((name, table, sql))
+    return failures
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    for key, value in sorted(DEFAULTS.items()):
+        parser.add_option('--%s' % key, dest=key, default=value,
+            type='float' if isinstance(value, float) else 'int',
+            help='default: %default')
+    parser.add_option('--min-rows', dest='min_rows', type='int', default=1000,
+        help='tables above this number of rows must not be scanned, '
+        'default: %default')
+    options, _ = parser.parse_args(args)
+
+    parameters = dict((key, getattr(options, key)) for key in DEFAULTS)
+    with catalog(parameters) as (_, _, context):
+        failures = check(context, options.min_rows)
+    for name, table, sql in failures:
+        print '%s: sequential scan of %s in %s' % (name, table, sql)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
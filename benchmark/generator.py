@@ -0,0 +1,129 @@
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+import random
+from bisect import bisect
+
+from trytond.pool import Pool
+
+__all__ = ['DEFAULTS', 'generate']
+
+DEFAULTS = {
+    'songbooks': 2,
+    'publishers': 10,
+    'albums': 100,
+    'tracks': 15,
+    'artists': 500,
+    'songs': 2000,
+    'zipf': 1.1,
+    'seed': 42,
+}
+CREATE_BATCH_SIZE = 1000
+
+_SYLLABLES = ['ka', 'ro', 'mi', 'lu', 'sa', 'ne', 'to', 'bi', 'da', 'vo',
+    'ri', 'el', 'an', 'or', 'us', 'in']
+
+
+def _word(rng, syllables=(1, 3)):
+    return ''.join(rng.choice(_SYLLABLES)
+        for _ in range(rng.randint(*syllables))).capitalize()
+
+
+def _words(rng, count):
+    return ' '.join(_word(rng) for _ in range(count))
+
+
+def _create(Model, vlist):
+    "Create the records by batches and return their ids"
+    ids = []
+    for i in range(0, len(vlist), CREATE_BATCH_SIZE):
+        ids.extend(r.id for r in Model.create(vlist[i:i + CREATE_BATCH_SIZE]))
+    return ids
+
+
+def generate(**parameters):
+    """
+    Fill the database of the current transaction with a synthetic catalog.
+
+    The parameters are those of DEFAULTS: the number of songbooks,
+    publishers, artists and songs, the number of albums per songbook and
+    tracks per album, the exponent of the Zipf distribution of songs among
+    artists and the seed of the random generator. The same parameters
+    always generate the same catalog.
+    Return the number of records created per model.
+    """
+    pool = Pool()
+    Songbook = pool.get('songbook.songbook')
+    Publisher = pool.get('songbook.publisher')
+    Artist = pool.get('songbook.artist')
+    Song = pool.get('songbook.song')
+    Album = pool.get('songbook.album')
+    Track = pool.get('songbook.track')
+
+    values = DEFAULTS.copy()
+    values.update(parameters)
+    rng = random.Random(values['seed'])
+
+    songbook_ids = _create(Songbook, [{
+                'name': 'Songbook %s' % i,
+                } for i in range(values['songbooks'])])
+
+    publisher_codes = ['P%03d' % i for i in range(values['publishers'])]
+    publisher_ids = _create(Publisher, [{
+                'code': code,
+                'name': _words(rng, 2),
+                } for code in publisher_codes])
+
+    names = set()
+    while len(names) < values['artists']:
+        names.add((_word(rng), _word(rng) if rng.random() < 0.7 else None))
+    artist_ids = _create(Artist, [{
+                'last_name': last_name,
+                'first_name': first_name,
+                } for last_name, first_name in sorted(names)])
+
+    # Rank k gets a weight of 1 / k ** s, so a few artists own most songs
+    cumulated = []
+    total = 0.
+    for rank in range(1, len(artist_ids) + 1):
+        total += 1. / rank ** values['zipf']
+        cumulated.append(total)
+    songs = set()
+    while len(songs) < values['songs']:
+        artist = min(bisect(cumulated, rng.random() * total),
+            len(artist_ids) - 1)
+        songs.add((_words(rng, rng.randint(1, 4)), artist_ids[artist]))
+    song_ids = _create(Song, [{
+                'title': title,
+                'artist': artist_id,
+                } for title, artist_id in sorted(songs)])
+
+    album_vlist = []
+    for songbook_id in songbook_ids:
+        for i in range(values['albums']):
+            publisher = rng.randrange(len(publisher_ids))
+            album_vlist.append({
+                    'songbook': songbook_id,
+                    'code': '%s%04d' % (publisher_codes[publisher], i),
+                    'name': _words(rng, 3),
+                    'publisher': publisher_ids[publisher],
+                    })
+    album_ids = _create(Album, album_vlist)
+
+    track_vlist = []
+    for album_id, album in zip(album_ids, album_vlist):
+        for i in range(values['tracks']):
+            track_vlist.append({
+                    'album': album_id,
+                    'code': '%s-%02d' % (album['code'], i + 1),
+                    'song': rng.choice(song_ids),
+                    })
+    track_ids = _create(Track, track_vlist)
+
+    return {
+        'songbook.songbook': len(songbook_ids),
+        'songbook.publisher': len(publisher_ids),
+        'songbook.artist': len(artist_ids),
+        'songbook.song': len(song_ids),
+        'songbook.album': len(album_ids),
+        'songbook.track': len(track_ids),
+    }
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+"""
+Time the hot paths of the songbook module on a synthetic catalog loaded in
+the SQLite test database and write the results as JSON.
+"""
+import json
+import optparse
+import platform
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from multiprocessing import cpu_count
+
+from trytond.config import CONFIG
+from trytond.tests.test_tryton import (install_module, POOL, DB_NAME, USER,
+    CONTEXT)
+from trytond.transaction import Transaction
+from trytond.version import VERSION as trytond_version
+from nereid.testing import NereidTestCase
+
+from ..profiling import QueryRecorder
+from .generator import DEFAULTS, generate
+
+__all__ = ['BENCHMARKS', 'TEMPLATES', 'catalog', 'run', 'main']
+
+# Minimal templates rendering what the themes usually show
+TEMPLATES = {
+    'songbook_home.jinja': 'home',
+    'songbook_songbook-list.jinja':
+        '{% for s in songbooks %}{{ s.name }}\n{% endfor %}',
+    'songbook_artist-list.jinja':
+        '{% for a in artists %}{{ a.full_name }}\n{% endfor %}',
+    'songbook_song-list.jinja':
+        '{% for s in songs %}{{ s.title }}|{{ s.artist.full_name }}\n'
+        '{% endfor %}',
+    'songbook_songbook-detail.jinja':
+        '{{ songbook.name }}\n{% for a in songbook.albums %}'
+        '{{ a.code }} {{ a.name }} {{ a.publisher.name }}\n'
+        '{% for t in a.tracks %}{{ t.code }}|{{ t.song.title }}|'
+        '{{ t.song.artist.full_name }}\n{% endfor %}{% endfor %}',
+    'songbook_artist-detail.jinja':
+        '{{ artist.full_name }}\n{% for s in artist.songs %}{{ s.title }}\n'
+        '{% for t in s.tracks %}{{ t.code }} {{ t.album.name }} '
+        '{{ t.album.songbook.name }}\n{% endfor %}{% endfor %}',
+    'songbook_song-detail.jinja':
+        '{{ song.title }} {{ song.artist.full_name }}\n'
+        '{% for t in song.tracks %}{{ t.code }} {{ t.album.name }} '
+        '{{ t.album.publisher.name }} {{ t.album.songbook.name }}\n'
+        '{% endfor %}',
+    'songbook_songlist-txt.jinja':
+        '{% for t in tracks %}{{ t.code }}|{{ t.song.title }}|'
+        '{{ t.song.artist.full_name }}\n{% endfor %}',
+}
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    "Register the decorated function as the benchmark name"
+    def decorator(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return decorator
+
+
+class _Website(NereidTestCase):
+    templates = TEMPLATES
+
+    def runTest(self):
+        pass
+
+
+def setup_website():
+    "Create the nereid website and return the test application"
+    pool = POOL
+    Currency = pool.get('currency.currency')
+    Party = pool.get('party.party')
+    Company = pool.get('company.company')
+    NereidUser = pool.get('nereid.user')
+    UrlMap = pool.get('nereid.url_map')
+    Lang = pool.get('ir.lang')
+    Locale = pool.get('nereid.website.locale')
+    Website = pool.get('nereid.website')
+
+    currency, = Currency.create([{
+                'name': 'US Dollar',
+                'code': 'USD',
+                'symbol': '$',
+                }])
+    party, guest_party = Party.create([{
+                'name': 'Songbook',
+                }, {
+                'name': 'Guest',
+                }])
+    company, = Company.create([{
+                'party': party.id,
+                'currency': currency.id,
+                }])
+    guest, = NereidUser.create([{
+                'party': guest_party.id,
+                'display_name': 'Guest',
+                'email': 'guest@example.com',
+                'password': 'password',
+                'company': company.id,
+                }])
+    url_map, = UrlMap.search([], limit=1)
+    lang, = Lang.search([('code', '=', 'en_US')])
+    locale, = Locale.create([{
+                'code': 'en_US',
+                'language': lang.id,
+                'currency': currency.id,
+                }])
+    Website.create([{
+                'name': 'localhost',
+                'url_map': url_map.id,
+                'company': company.id,
+                'application_user': USER,
+                'default_locale': locale.id,
+                'guest_user': guest.id,
+                }])
+    return _Website().get_app()
+
+
+def _export(mode, index=False):
+    def bench(context):
+        ExportTracks = POOL.get('songbook.songbook.export_tracks',
+            type='wizard')
+        with Transaction().set_context(active_ids=context['songbook_ids']):
+            session_id, _, _ = ExportTracks.create()
+            export = ExportTracks(session_id)
+            export.start.mode = mode
+            export.start.background = False
+            export.start.index = index
+            export.transition_export()
+            export.transition_done()
+            ExportTracks.delete(session_id)
+    return bench
+
+benchmark('export_tracks')(_export('full'))
+benchmark('export_tracks (delta)')(_export('delta'))
+benchmark('export_tracks (index)')(_export('full', True))
+
+
+def _songbook_by_artist(processes):
+    def bench(context):
+        ActionReport = POOL.get('ir.action.report')
+        Songbook = POOL.get('songbook.songbook')
+        SongbookByArtist = POOL.get('songbook.songs_by_artist',
+            type='report')
+        report, = ActionReport.search([
+                ('report_name', '=', 'songbook.songs_by_artist'),
+                ])
+        SongbookByArtist.parse(report,
+            Songbook.browse(context['songbook_ids']),
+            {'processes': processes}, {})
+    return bench
+
+benchmark('songbook_by_artist.parse')(_songbook_by_artist(0))
+benchmark('songbook_by_artist.parse (parallel)')(
+    _songbook_by_artist(cpu_count()))
+
+
+@benchmark('songbook.songs_title')
+def bench_songs_title(context):
+    Songbook = POOL.get('songbook.songbook')
+    Songbook.read(context['songbook_ids'], ['songs_title'])
+
+
+@benchmark('songbook.songs_artist')
+def bench_songs_artist(context):
+    Songbook = POOL.get('songbook.songbook')
+    Songbook.read(context['songbook_ids'], ['songs_artist'])
+
+
+def _get(url):
+    def bench(context):
+        response = context['client'].get(url % context)
+        assert response.status_code == 200, (url, response.status_code)
+        response.data
+    return bench
+
+for name, url in [
+        ('GET /songbook/api/songs', '/songbook/api/songs?titlecontains=ka'),
+        ('GET /songbook/api/artists',
+            '/songbook/api/artists?namecontains=ka'),
+        ('GET /songbook/api/search', '/songbook/api/search?q=ka%20ro'),
+        ('GET /songbook/api/catalog.ndjson', '/songbook/api/catalog.ndjson'),
+        ('GET /songbook/songbooks', '/songbook/songbooks'),
+        ('GET /songbook/artists', '/songbook/artists'),
+        ('GET /songbook/songs', '/songbook/songs'),
+        ('GET /songbook/songs (last page)',
+            '/songbook/songs?page=%(last_song_page)s'),
+        ('GET /songbook/albums/<code>.txt',
+            '/songbook/albums/%(album_code)s.txt'),
+        ('GET /songbook/songbooks/<id>',
+            '/songbook/songbooks/%(songbook_id)s'),
+        ('GET /songbook/artists/<id>', '/songbook/artists/%(artist_id)s'),
+        ('GET /songbook/songs/<id>', '/songbook/songs/%(song_id)s'),
+        ]:
+    benchmark(name)(_get(url))
+
+
+def _get_cached(url):
+    "Return the benchmark of url answered from the response cache"
+    get = _get(url)
+
+    def bench(context):
+        ttl = CONFIG.get('songbook_response_cache_ttl')
+        CONFIG['songbook_response_cache_ttl'] = 60
+        try:
+            get(context)
+        finally:
+            CONFIG['songbook_response_cache_ttl'] = ttl
+    return bench
+
+for name, url in [
+        ('GET /songbook/api/songs (cached)',
+            '/songbook/api/songs?titlecontains=ka'),
+        ('GET /songbook/songs (cached)', '/songbook/songs'),
+        ]:
+    benchmark(name)(_get_cached(url))
+
+
+def _timings(name, func, context, repeat):
+    durations = []
+    with QueryRecorder(name) as recorder:
+        start = time.time()
+        func(context)
+        durations.append(time.time() - start)
+    for _ in range(repeat - 1):
+        start = time.time()
+        func(context)
+        durations.append(time.time() - start)
+    first = durations[0]
+    durations.sort()
+    return {
+        'repeat': repeat,
+        'first': first,
+        'min': durations[0],
+        'median': durations[len(durations) // 2],
+        'mean': sum(durations) / len(durations),
+        'max': durations[-1],
+        'queries': recorder.count,
+        'repeated_queries': len(recorder.repeated()),
+    }
+
+
+@contextmanager
+def catalog(parameters):
+    """
+    Generate the catalog with the parameters in a transaction rolled back at
+    the end and yield the number of created records, the generation time
+    and the context of the benchmarks.
+    """
+    install_module('songbook')
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        Songbook = POOL.get('songbook.songbook')
+        Album = POOL.get('songbook.album')
+        Artist = POOL.get('songbook.artist')
+        Song = POOL.get('songbook.song')
+
+        start = time.time()
+        counts = generate(**parameters)
+        generation = time.time() - start
+
+        app = setup_website()
+        album, = Album.search([], limit=1)
+        songbook_ids = [s.id for s in Songbook.search([])]
+        # The first created artist has the most songs in the Zipf ranking
+        artist, = Artist.search([], order=[('id', 'ASC')], limit=1)
+        song, = Song.search([('artist', '=', artist.id)], limit=1)
+        context = {
+            'songbook_ids': songbook_ids,
+            'songbook_id': songbook_ids[0],
+            'artist_id': artist.id,
+            'song_id': song.id,
+            'album_code': album.code,
+            'last_song_page': (Song.search([], count=True) - 1) // 25 + 1,
+        }
+        try:
+            with app.test_client() as client:
+                context['client'] = client
+                yield counts, generation, context
+        finally:
+            Transaction().cursor.rollback()
+
+
+def run(parameters=None, repeat=5, names=None):
+    """
+    Generate the catalog with the parameters and time the benchmarks
+    (all when names is None). Return the results as a dictionary.
+    """
+    parameters = dict(DEFAULTS, **(parameters or {}))
+    results = []
+    with catalog(parameters) as (counts, generation, context):
+        for name, func in BENCHMARKS:
+            if names and name not in names:
+                continue
+            result = _timings(name, func, context, repeat)
+            result['name'] = name
+            results.append(result)
+
+    return {
+        'date': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'trytond': trytond_version,
+        'database': 'sqlite',
+        'parameters': parameters,
+        'records': counts,
+        'generation': generation,
+        'results': results,
+    }
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options] [benchmark ...]')
+    for key, value in sorted(DEFAULTS.items()):
+        parser.add_option('--%s' % key, dest=key, default=value,
+            type='float' if isinstance(value, float) else 'int',
+            help='default: %default')
+    parser.add_option('--repeat', dest='repeat', type='int', default=5,
+        help='number of runs of each benchmark, default: %default')
+    parser.add_option('-o', '--output', dest='output',
+        help='write the results to this file instead of stdout')
+    parser.add_option('-l', '--list', dest='list', action='store_true',
+        help='list the benchmarks and exit')
+    options, names = parser.parse_args(args)
+
+    if options.list:
+        for name, _ in BENCHMARKS:
+            print name
+        return
+
+    parameters = dict((key, getattr(options, key)) for key in DEFAULTS)
+    result = run(parameters, repeat=options.repeat, names=names)
+    output = open(options.output, 'w') if options.output else sys.stdout
+    try:
+        json.dump(result, output, indent=2, sort_keys=True)
+        output.write('\n')
+    finally:
+        if options.output:
+            output.close()
+
+if __name__ == '__main__':
+    main()
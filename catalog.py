@@ -0,0 +1,913 @@
+import datetime
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.transaction import Transaction
+from trytond.pool import Pool
+from trytond.wizard import Wizard, StateView, Button, StateTransition
+from trytond.cache import Cache
+from trytond.config import CONFIG
+from trytond import backend
+from sql import Column, Literal, Flavor
+from sql.aggregate import Count, Min
+from sql.conditionals import Case, Coalesce
+from sql.functions import Now
+from sql.operators import Concat, In, ILike, Or, Exists
+
+from .index import tokenize
+from .tools import to_datetime, update_column
+
+__all__ = [
+    'Catalog',
+    'CatalogDeletion',
+    'RebuildCatalog',
+    'RebuildCatalogStart',
+    'CheckStatistics',
+    'CheckStatisticsStart',
+]
+
+# The statistics stored on the records of the catalog columns
+STATISTICS = {
+    'songbook': ['album_count', 'track_count', 'song_count', 'artist_count'],
+    'publisher': ['album_count', 'track_count', 'song_count', 'artist_count'],
+    'artist': ['track_count', 'song_count'],
+}
+_STATISTICS_MODELS = {
+    'songbook': 'songbook.songbook',
+    'publisher': 'songbook.publisher',
+    'artist': 'songbook.artist',
+}
+
+# The best matching tracks from which the songs are ranked
+FULLTEXT_TRACKS_MAX = 1000
+_FULLTEXT_DOCUMENT = ("setweight(to_tsvector('simple', "
+    "coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(artist_full_name, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(album_name, '')), 'C') || "
+    "setweight(to_tsvector('simple', coalesce(code, '')), 'D')")
+
+
+class Catalog(ModelSQL, ModelView):
+    "Songbook Catalog"
+    __name__ = 'songbook.catalog'
+    # One denormalized row per track, with the same id as the track, holding
+    # what the exports, reports and web pages read about it. Rows are
+    # maintained by the create, write and delete methods of the tracks and
+    # of the records they depend on.
+
+    track = fields.Many2One('songbook.track', 'Track', readonly=True,
+        ondelete='CASCADE')
+    songbook = fields.Many2One('songbook.songbook', 'Songbook',
+        readonly=True, select=True, ondelete='CASCADE')
+    album = fields.Many2One('songbook.album', 'Album', readonly=True,
+        select=True, ondelete='CASCADE')
+    publisher = fields.Many2One('songbook.publisher', 'Publisher',
+        readonly=True, select=True, ondelete='CASCADE')
+    song = fields.Many2One('songbook.song', 'Song', readonly=True,
+        select=True, ondelete='CASCADE')
+    artist = fields.Many2One('songbook.artist', 'Artist', readonly=True,
+        select=True, ondelete='CASCADE')
+    code = fields.Char('Code', readonly=True, select=True)
+    album_code = fields.Char('Album Code', readonly=True)
+    album_name = fields.Char('Album Name', readonly=True)
+    publisher_code = fields.Char('Publisher Code', readonly=True)
+    title = fields.Char('Title', readonly=True)
+    title_sort = fields.Char('Title Sort Key', readonly=True)
+    artist_last_name = fields.Char('Artist Last Name', readonly=True)
+    artist_first_name = fields.Char('Artist First Name', readonly=True)
+    artist_full_name = fields.Char('Artist Full Name', readonly=True)
+    artist_rev_name = fields.Char('Artist Reversed Name', readonly=True)
+    artist_sort_name = fields.Char('Artist Sort Name', readonly=True)
+    line = fields.Char('Jukebox Line', readonly=True)
+    # The catalog versions of the songbook when the row was last written and
+    # when the track was added to the songbook
+    version = fields.Integer('Version', readonly=True)
+    added_version = fields.Integer('Added Version', readonly=True)
+    _fulltext_cache = Cache('songbook.catalog.fulltext', context=False)
+
+    @classmethod
+    def __setup__(cls):
+        super(Catalog, cls).__setup__()
+        cls._order.insert(0, ('songbook', 'ASC'))
+        cls._order.insert(1, ('code', 'ASC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        created = not TableHandler.table_exist(cursor, cls._table)
+
+        super(Catalog, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['songbook', 'code'], 'add')
+        table.index_action(['songbook', 'version'], 'add')
+        table.index_action(['songbook', 'title_sort'], 'add')
+        table.index_action(['songbook', 'artist_sort_name'], 'add')
+
+        cls.create_fulltext_index()
+
+        if created:
+            cls.rebuild()
+        else:
+            cls.update_sort_keys()
+            cls.rebuild_statistics(missing=True)
+
+    @classmethod
+    def bump_versions(cls, songbook_ids):
+        """
+        Increment the catalog version of the songbooks and return the new
+        versions by id. Their rows stay locked until the end of the
+        transaction, so the versions of a songbook follow the commit order
+        of the changes of its catalog: a delta export reading a version has
+        all the rows and deletions up to it.
+        """
+        Songbook = Pool().get('songbook.songbook')
+        cursor = Transaction().cursor
+        songbook = Songbook.__table__()
+        songbook_ids = sorted(set(songbook_ids))
+        versions = {}
+        for i in range(0, len(songbook_ids), cursor.IN_MAX):
+            sub_ids = songbook_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*songbook.update([songbook.catalog_version],
+                    [Coalesce(songbook.catalog_version, 0) + 1],
+                    where=In(songbook.id, sub_ids)))
+            cursor.execute(*songbook.select(songbook.id,
+                    songbook.catalog_version,
+                    where=In(songbook.id, sub_ids)))
+            versions.update(cursor.fetchall())
+        return versions
+
+    @classmethod
+    def update_sort_keys(cls):
+        "Copy the sort keys of the songs and artists that differ"
+        pool = Pool()
+        Song = pool.get('songbook.song')
+        Artist = pool.get('songbook.artist')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        song = Song.__table__()
+        artist = Artist.__table__()
+
+        title_sort = song.select(song.title_sort,
+            where=song.id == table.song)
+        artist_sort_name = artist.select(artist.sort_name,
+            where=artist.id == table.artist)
+        cursor.execute(*table.update(
+                [table.title_sort, table.artist_sort_name],
+                [title_sort, artist_sort_name],
+                where=(table.title_sort == None)
+                | (table.artist_sort_name == None)
+                | Exists(song.select(song.id,
+                        where=(song.id == table.song)
+                        & (song.title_sort != table.title_sort)))
+                | Exists(artist.select(artist.id,
+                        where=(artist.id == table.artist)
+                        & (artist.sort_name != table.artist_sort_name)))))
+
+    @classmethod
+    def create_fulltext_index(cls):
+        """
+        Create the full-text index of the title, artist full name, album name
+        and code: a GIN index on PostgreSQL, an FTS5 table maintained by
+        triggers on SQLite. Nothing is done when the backend does not support
+        it, search_fulltext then falls back to ILIKE.
+        """
+        cursor = Transaction().cursor
+        table = cls._table
+        if CONFIG['db_type'] == 'postgresql':
+            index_name = '%s_fulltext_index' % table
+            cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s',
+                (index_name,))
+            if not cursor.fetchone():
+                cursor.execute('CREATE INDEX "%s" ON "%s" USING gin ((%s))'
+                    % (index_name, table, _FULLTEXT_DOCUMENT))
+        elif CONFIG['db_type'] == 'sqlite':
+            fts = '%s_fts' % table
+            cursor.execute('SELECT 1 FROM sqlite_master WHERE name = ?',
+                (fts,))
+            if cursor.fetchone():
+                return
+            try:
+                cursor.execute('CREATE VIRTUAL TABLE "%s" USING fts5('
+                    'title, artist_full_name, album_name, code, '
+                    'content="%s", content_rowid="id")' % (fts, table))
+            except Exception:
+                return
+            columns = 'rowid, title, artist_full_name, album_name, code'
+            new = 'new.id, new.title, new.artist_full_name, new.album_name, '\
+                'new.code'
+            old = 'old.id, old.title, old.artist_full_name, old.album_name, '\
+                'old.code'
+            insert = 'INSERT INTO "%s" (%s) VALUES (%s);' % (fts, columns, new)
+            delete = ('INSERT INTO "%s" ("%s", %s) VALUES (\'delete\', %s);'
+                % (fts, fts, columns, old))
+            for name, event, body in [
+                    ('ai', 'INSERT', insert),
+                    ('ad', 'DELETE', delete),
+                    ('au', 'UPDATE', delete + ' ' + insert),
+                    ]:
+                cursor.execute('CREATE TRIGGER "%s_%s" AFTER %s ON "%s" '
+                    'BEGIN %s END' % (fts, name, event, table, body))
+            cursor.execute('INSERT INTO "%s" ("%s") VALUES (\'rebuild\')'
+                % (fts, fts))
+        cls._fulltext_cache.clear()
+
+    @classmethod
+    def has_fulltext_index(cls):
+        result = cls._fulltext_cache.get('exist')
+        if result is None:
+            cursor = Transaction().cursor
+            if CONFIG['db_type'] == 'postgresql':
+                cursor.execute('SELECT 1 FROM pg_indexes '
+                    'WHERE indexname = %s', ('%s_fulltext_index' % cls._table,))
+            elif CONFIG['db_type'] == 'sqlite':
+                cursor.execute('SELECT 1 FROM sqlite_master WHERE name = ?',
+                    ('%s_fts' % cls._table,))
+            result = bool(CONFIG['db_type'] in ('postgresql', 'sqlite')
+                and cursor.fetchone())
+            cls._fulltext_cache.set('exist', result)
+        return result
+
+    @classmethod
+    def search_fulltext(cls, text, limit, songbook=None):
+        """
+        Return the ids of at most limit songs whose tracks match every word
+        of text as a prefix of a word of their title, artist, album name or
+        code, the most relevant first. Title matches weigh more than artist
+        ones, which weigh more than album and code ones.
+        """
+        words = tokenize(text)
+        if not words:
+            return []
+        if not cls.has_fulltext_index():
+            return cls._search_ilike(words, limit, songbook)
+
+        cursor = Transaction().cursor
+        param = Flavor.get().param
+        params = []
+        if CONFIG['db_type'] == 'postgresql':
+            params.append(' & '.join('%s:*' % w for w in words))
+            where = ''
+            if songbook is not None:
+                where = ' AND songbook = %s' % param
+                params.append(songbook)
+            query = ('SELECT song, MAX(score) FROM ('
+                'SELECT song, ts_rank(%(document)s, query) AS score '
+                'FROM "%(table)s", to_tsquery(\'simple\', %(param)s) AS query '
+                'WHERE %(document)s @@ query%(where)s '
+                'ORDER BY score DESC LIMIT %(max)s) AS tracks '
+                'GROUP BY song ORDER BY MAX(score) DESC, song LIMIT %(param)s'
+                % {
+                    'document': _FULLTEXT_DOCUMENT,
+                    'table': cls._table,
+                    'param': param,
+                    'where': where,
+                    'max': FULLTEXT_TRACKS_MAX,
+                    })
+        else:
+            params.append(' '.join('"%s"*' % w for w in words))
+            where = ''
+            if songbook is not None:
+                where = ' AND c.songbook = %s' % param
+                params.append(songbook)
+            query = ('SELECT song, MIN(score) FROM ('
+                'SELECT c.song AS song, '
+                'bm25("%(fts)s", 10.0, 5.0, 2.0, 1.0) AS score '
+                'FROM "%(fts)s" JOIN "%(table)s" AS c ON c.id = "%(fts)s".rowid '
+                'WHERE "%(fts)s" MATCH %(param)s%(where)s '
+                'ORDER BY score LIMIT %(max)s) '
+                'GROUP BY song ORDER BY MIN(score), song LIMIT %(param)s'
+                % {
+                    'fts': '%s_fts' % cls._table,
+                    'table': cls._table,
+                    'param': param,
+                    'where': where,
+                    'max': FULLTEXT_TRACKS_MAX,
+                    })
+        params.append(limit)
+        cursor.execute(query, params)
+        return [r[0] for r in cursor.fetchall()]
+
+    @classmethod
+    def _search_ilike(cls, words, limit, songbook=None):
+        "Fallback of search_fulltext ranking by title"
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        where = Literal(True)
+        for word in words:
+            pattern = '%' + word + '%'
+            where &= Or([ILike(c, pattern) for c in (table.title,
+                        table.artist_full_name, table.album_name, table.code)])
+        if songbook is not None:
+            where &= table.songbook == songbook
+        cursor.execute(*table.select(table.song,
+                where=where,
+                group_by=[table.song],
+                order_by=[Min(table.title_sort), table.song],
+                limit=limit))
+        return [r[0] for r in cursor.fetchall()]
+
+    @staticmethod
+    def jukebox_columns(track, album, publisher, song, artist):
+        """
+        Return the SQL expressions of the three columns of a jukebox export
+        line: track code, title with publisher code and artist name.
+        """
+        title_and_publisher = Concat(
+            song.title, Concat(
+                Literal(' .'), Concat(publisher.code, Literal('.'))
+            )
+        )
+
+        artist_fullname = Concat(
+            Coalesce(artist.first_name, Literal('')),
+            Concat(
+                Literal(' '),
+                Coalesce(artist.last_name, Literal(''))
+            )
+        )
+        return track.code, title_and_publisher, artist_fullname
+
+    @classmethod
+    def _catalog_query(cls, table, track_ids=None):
+        """
+        Return the columns of the catalog table and the query computing
+        them for the tracks (all when None).
+        """
+        pool = Pool()
+        Songbook = pool.get('songbook.songbook')
+        Song = pool.get('songbook.song')
+        Artist = pool.get('songbook.artist')
+        Publisher = pool.get('songbook.publisher')
+        Album = pool.get('songbook.album')
+        Track = pool.get('songbook.track')
+
+        songbook = Songbook.__table__()
+        song = Song.__table__()
+        artist = Artist.__table__()
+        publisher = Publisher.__table__()
+        album = Album.__table__()
+        track = Track.__table__()
+
+        code, title_and_publisher, artist_fullname = cls.jukebox_columns(
+            track, album, publisher, song, artist)
+        line = Concat(code, Concat(Literal('|'), Concat(
+                    title_and_publisher, Concat(Literal('|'),
+                        artist_fullname))))
+        rev_name = Case(
+            (artist.first_name == None, artist.last_name),
+            else_=Concat(artist.last_name, Concat(
+                    Literal(', '), artist.first_name)))
+
+        columns = [
+            (table.id, track.id),
+            (table.create_uid, Literal(Transaction().user)),
+            (table.create_date, Now()),
+            (table.track, track.id),
+            (table.songbook, album.songbook),
+            (table.album, album.id),
+            (table.publisher, publisher.id),
+            (table.song, song.id),
+            (table.artist, artist.id),
+            (table.code, track.code),
+            (table.album_code, album.code),
+            (table.album_name, album.name),
+            (table.publisher_code, publisher.code),
+            (table.title, song.title),
+            (table.title_sort, song.title_sort),
+            (table.artist_last_name, artist.last_name),
+            (table.artist_first_name, artist.first_name),
+            (table.artist_full_name, artist.full_name),
+            (table.artist_rev_name, rev_name),
+            (table.artist_sort_name, artist.sort_name),
+            (table.line, line),
+            (table.version, songbook.catalog_version),
+            (table.added_version, songbook.catalog_version),
+        ]
+        query = track.join(
+            album, condition=(album.id == track.album)
+        ).join(
+            songbook, condition=(songbook.id == album.songbook)
+        ).join(
+            publisher, condition=(publisher.id == album.publisher)
+        ).join(
+            song, condition=(song.id == track.song)
+        ).join(
+            artist, condition=(artist.id == song.artist)
+        ).select(
+            *[c[1] for c in columns],
+            where=In(track.id, track_ids) if track_ids is not None else None
+        )
+        return [c[0] for c in columns], query
+
+    @classmethod
+    def rebuild(cls):
+        "Recompute the whole catalog"
+        pool = Pool()
+        Songbook = pool.get('songbook.songbook')
+        Album = pool.get('songbook.album')
+        Track = pool.get('songbook.track')
+        Deletion = pool.get('songbook.catalog.deletion')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        deletion = Deletion.__table__()
+        songbook = Songbook.__table__()
+        album = Album.__table__()
+        track = Track.__table__()
+
+        cursor.execute(*songbook.update([songbook.catalog_version],
+                [Coalesce(songbook.catalog_version, 0) + 1]))
+        cursor.execute(*table.select(table.id, table.songbook,
+                table.added_version))
+        added = cursor.fetchall()
+        cursor.execute(*deletion.insert([
+                    deletion.create_uid, deletion.create_date,
+                    deletion.songbook, deletion.code, deletion.version,
+                    ], table.join(songbook,
+                    condition=songbook.id == table.songbook
+                    ).select(
+                    Literal(Transaction().user), Now(),
+                    table.songbook, table.code, songbook.catalog_version,
+                    where=~Exists(track.join(album,
+                            condition=album.id == track.album
+                            ).select(track.id,
+                            where=(album.songbook == table.songbook)
+                            & (track.code == table.code))))))
+        cursor.execute(*table.delete())
+        columns, query = cls._catalog_query(table)
+        cursor.execute(*table.insert(columns, query))
+        cls._keep_added_versions(added)
+        cls.rebuild_statistics()
+
+    @classmethod
+    def _select_added_versions(cls, track_ids):
+        "Return the id, songbook and added version of the catalog rows"
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        cursor.execute(*table.select(table.id, table.songbook,
+                table.added_version, where=In(table.id, track_ids)))
+        return cursor.fetchall()
+
+    @classmethod
+    def _keep_added_versions(cls, added):
+        """
+        Restore the added versions of the rows recomputed in the same
+        songbook from the (id, songbook, added version) of their old rows
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        added = dict((id_, (songbook, version))
+            for id_, songbook, version in added)
+        values = {}
+        ids = added.keys()
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(table.id, table.songbook,
+                    table.added_version, where=In(table.id, sub_ids)))
+            for id_, songbook, version in cursor.fetchall():
+                old_songbook, old_version = added[id_]
+                if old_songbook == songbook and old_version != version:
+                    values[id_] = old_version
+        update_column(cursor, table, table.added_version, values)
+
+    @classmethod
+    def _select_rows(cls, track_ids):
+        """
+        Return the songbook, track code, publisher, song and artist of the
+        catalog rows of the tracks
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        cursor.execute(*table.select(table.songbook, table.code,
+                table.publisher, table.song, table.artist,
+                where=In(table.id, track_ids)))
+        return cursor.fetchall()
+
+    @classmethod
+    def refresh(cls, track_ids):
+        """
+        Recompute the catalog rows of the tracks, log the track codes that
+        disappear from their songbook and update the statistics
+        """
+        pool = Pool()
+        Deletion = pool.get('songbook.catalog.deletion')
+        Album = pool.get('songbook.album')
+        Track = pool.get('songbook.track')
+        Song = pool.get('songbook.song')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        album = Album.__table__()
+        track = Track.__table__()
+        song = Song.__table__()
+        track_ids = list(set(track_ids))
+        for i in range(0, len(track_ids), cursor.IN_MAX):
+            sub_ids = track_ids[i:i + cursor.IN_MAX]
+            old = cls._select_rows(sub_ids)
+            added = cls._select_added_versions(sub_ids)
+            cursor.execute(*track.join(song,
+                    condition=song.id == track.song
+                    ).join(album,
+                    condition=album.id == track.album
+                    ).select(track.song, song.artist, album.songbook,
+                    where=In(track.id, sub_ids)))
+            rows = cursor.fetchall()
+            versions = cls.bump_versions(
+                [r[0] for r in old] + [r[2] for r in rows])
+            songs_artists = [r[3:] for r in old] + [r[:2] for r in rows]
+            before = cls._statistics_snapshot(songs_artists)
+            cursor.execute(*table.delete(where=In(table.id, sub_ids)))
+            columns, query = cls._catalog_query(table, sub_ids)
+            cursor.execute(*table.insert(columns, query))
+            cls._keep_added_versions(added)
+            new = cls._select_rows(sub_ids)
+            Deletion.log(set(r[:2] for r in old) - set(r[:2] for r in new),
+                versions)
+            cls._update_statistics(before,
+                cls._statistics_snapshot(songs_artists), old + new)
+
+    @classmethod
+    def forget(cls, track_ids):
+        """
+        Remove the catalog rows of the tracks being deleted and update the
+        statistics
+        """
+        Deletion = Pool().get('songbook.catalog.deletion')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        track_ids = list(set(track_ids))
+        for i in range(0, len(track_ids), cursor.IN_MAX):
+            sub_ids = track_ids[i:i + cursor.IN_MAX]
+            old = cls._select_rows(sub_ids)
+            Deletion.log(set(r[:2] for r in old),
+                cls.bump_versions(r[0] for r in old))
+            songs_artists = [r[3:] for r in old]
+            before = cls._statistics_snapshot(songs_artists)
+            cursor.execute(*table.delete(where=In(table.id, sub_ids)))
+            cls._update_statistics(before,
+                cls._statistics_snapshot(songs_artists), old)
+
+    @classmethod
+    def _statistics_snapshot(cls, songs_artists):
+        """
+        Return by catalog column and record the number of tracks and the
+        sets of songs and artists of the catalog rows of the songs or
+        artists of the (song, artist) pairs.
+        Only these rows change when the tracks of the pairs are refreshed,
+        so the difference between two snapshots is the change of the
+        statistics.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        song_ids = list(set(s for s, _ in songs_artists))
+        artist_ids = list(set(a for _, a in songs_artists))
+        snapshot = dict((f, {}) for f in STATISTICS)
+        if not songs_artists:
+            return snapshot
+        cursor.execute(*table.select(table.songbook, table.publisher,
+                table.artist, table.song, Count(Literal(1)),
+                where=In(table.song, song_ids) | In(table.artist, artist_ids),
+                group_by=[table.songbook, table.publisher, table.artist,
+                    table.song]))
+        for songbook, publisher, artist, song, count in cursor.fetchall():
+            for field, id_ in [
+                    ('songbook', songbook),
+                    ('publisher', publisher),
+                    ('artist', artist),
+                    ]:
+                values = snapshot[field].setdefault(id_, [0, set(), set()])
+                values[0] += count
+                values[1].add(song)
+                values[2].add(artist)
+        return snapshot
+
+    @classmethod
+    def _update_statistics(cls, before, after, rows):
+        """
+        Add the difference between the snapshots to the statistics and set
+        the date of the records whose statistics changed or which hold the
+        (songbook, code, publisher, song, artist) rows.
+        """
+        pool = Pool()
+        cursor = Transaction().cursor
+        touched = {
+            'songbook': set(r[0] for r in rows),
+            'publisher': set(r[2] for r in rows),
+            'artist': set(r[4] for r in rows),
+            }
+        empty = [0, (), ()]
+        for field, names in STATISTICS.iteritems():
+            Model = pool.get(_STATISTICS_MODELS[field])
+            table = Model.__table__()
+            # The records are updated together by identical changes
+            changes = {}
+            for id_ in set(before[field]) | set(after[field]):
+                old = before[field].get(id_, empty)
+                new = after[field].get(id_, empty)
+                deltas = {
+                    'track_count': new[0] - old[0],
+                    'song_count': len(new[1]) - len(old[1]),
+                    'artist_count': len(new[2]) - len(old[2]),
+                    }
+                deltas = tuple((n, deltas[n]) for n in names if deltas.get(n))
+                if deltas or id_ in touched[field]:
+                    changes.setdefault(deltas, []).append(id_)
+            for deltas, ids in changes.iteritems():
+                columns = [table.stats_date]
+                values = [Now()]
+                for name, delta in deltas:
+                    column = Column(table, name)
+                    columns.append(column)
+                    values.append(column + delta)
+                cursor.execute(*table.update(columns, values,
+                        where=In(table.id, ids)))
+
+    @classmethod
+    def _statistics_values(cls, field, table):
+        """
+        Return the SQL expressions computing the statistics of the records
+        of the table of the catalog column
+        """
+        pool = Pool()
+        Album = pool.get('songbook.album')
+        Song = pool.get('songbook.song')
+        Artist = pool.get('songbook.artist')
+        catalog = cls.__table__()
+        album = Album.__table__()
+        song = Song.__table__()
+        artist = Artist.__table__()
+
+        def exists(column, target):
+            catalog = cls.__table__()
+            return Exists(catalog.select(catalog.id,
+                    where=(Column(catalog, column) == target.id)
+                    & (Column(catalog, field) == table.id)))
+
+        values = {
+            'track_count': catalog.select(Count(Literal(1)),
+                where=Column(catalog, field) == table.id),
+            'song_count': song.select(Count(Literal(1)),
+                where=exists('song', song)),
+            'artist_count': artist.select(Count(Literal(1)),
+                where=exists('artist', artist)),
+            }
+        if field != 'artist':
+            values['album_count'] = album.select(Count(Literal(1)),
+                where=Column(album, field) == table.id)
+        return [values[n] for n in STATISTICS[field]]
+
+    @classmethod
+    def rebuild_statistics(cls, missing=False):
+        """
+        Recompute the statistics of the songbooks, publishers and artists,
+        only of those without statistics date if missing: the counters of
+        the records existing when they were added default to 0.
+        """
+        pool = Pool()
+        cursor = Transaction().cursor
+        for field, names in STATISTICS.iteritems():
+            Model = pool.get(_STATISTICS_MODELS[field])
+            table = Model.__table__()
+            cursor.execute(*table.update(
+                    [Column(table, n) for n in names] + [table.stats_date],
+                    cls._statistics_values(field, table)
+                    + [Coalesce(table.stats_date, Now())],
+                    where=(table.stats_date == None) if missing else None))
+
+    @classmethod
+    def update_album_counts(cls, songbook_ids, publisher_ids):
+        "Recompute the number of albums of the songbooks and publishers"
+        pool = Pool()
+        Album = pool.get('songbook.album')
+        cursor = Transaction().cursor
+        album = Album.__table__()
+        for field, ids in [
+                ('songbook', songbook_ids),
+                ('publisher', publisher_ids),
+                ]:
+            Model = pool.get(_STATISTICS_MODELS[field])
+            table = Model.__table__()
+            ids = list(set(ids))
+            for i in range(0, len(ids), cursor.IN_MAX):
+                sub_ids = ids[i:i + cursor.IN_MAX]
+                cursor.execute(*table.update(
+                        [table.album_count, table.stats_date],
+                        [album.select(Count(Literal(1)),
+                                where=Column(album, field) == table.id),
+                            Now()],
+                        where=In(table.id, sub_ids)))
+
+    @classmethod
+    def serialize_statistics(cls, field, ids=None):
+        """
+        Return the statistics of the records of the catalog column as
+        dictionaries, in the order of ids or of their name when None,
+        skipping the ids of missing records
+        """
+        Model = Pool().get(_STATISTICS_MODELS[field])
+        cursor = Transaction().cursor
+        table = Model.__table__()
+        names = STATISTICS[field] + ['stats_date']
+        if field == 'artist':
+            label, name_column = 'fullName', table.full_name
+        else:
+            label, name_column = 'name', table.name
+        columns = [table.id, name_column] + [Column(table, n) for n in names]
+        if ids is None:
+            cursor.execute(*table.select(*columns,
+                    order_by=[name_column, table.id]))
+            rows = cursor.fetchall()
+        else:
+            rows = []
+            for i in range(0, len(ids), cursor.IN_MAX):
+                cursor.execute(*table.select(*columns,
+                        where=In(table.id, ids[i:i + cursor.IN_MAX])))
+                rows.extend(cursor.fetchall())
+            rows = dict((r[0], r) for r in rows)
+            rows = [rows[i] for i in ids if i in rows]
+        keys = [''.join([w.capitalize() if j else w
+                        for j, w in enumerate(n.split('_'))]) for n in names]
+        result = []
+        for row in rows:
+            payload = {
+                "objectType": Model.__name__,
+                "id": row[0],
+                label: row[1],
+            }
+            payload.update(zip(keys, row[2:]))
+            stats_date = to_datetime(payload['statsDate'])
+            payload['statsDate'] = stats_date and stats_date.isoformat()
+            result.append(payload)
+        return result
+
+    @classmethod
+    def check_statistics(cls):
+        """
+        Return the (model name, id, field name, stored value, actual value)
+        of the statistics which differ from their recomputed value
+        """
+        pool = Pool()
+        Album = pool.get('songbook.album')
+        cursor = Transaction().cursor
+        errors = []
+        for field, names in sorted(STATISTICS.iteritems()):
+            Model = pool.get(_STATISTICS_MODELS[field])
+            table = Model.__table__()
+            catalog = cls.__table__()
+            album = Album.__table__()
+            key = Column(catalog, field)
+
+            actual = dict((n, {}) for n in names)
+            cursor.execute(*catalog.select(key, Count(Literal(1)),
+                    group_by=[key]))
+            actual['track_count'].update(cursor.fetchall())
+            for name, column in [
+                    ('song_count', catalog.song),
+                    ('artist_count', catalog.artist),
+                    ]:
+                if name in names:
+                    pairs = catalog.select(key.as_('key'), group_by=[key,
+                            column])
+                    cursor.execute(*pairs.select(pairs.key,
+                            Count(Literal(1)), group_by=[pairs.key]))
+                    actual[name].update(cursor.fetchall())
+            if 'album_count' in names:
+                column = Column(album, field)
+                cursor.execute(*album.select(column, Count(Literal(1)),
+                        group_by=[column]))
+                actual['album_count'].update(cursor.fetchall())
+
+            cursor.execute(*table.select(table.id,
+                    *[Column(table, n) for n in names],
+                    order_by=[table.id]))
+            for row in cursor.fetchall():
+                for name, value in zip(names, row[1:]):
+                    expected = actual[name].get(row[0], 0)
+                    if value != expected:
+                        errors.append((Model.__name__, row[0], name, value,
+                                expected))
+        return errors
+
+    @classmethod
+    def refresh_for(cls, field, ids):
+        """
+        Recompute the catalog rows referencing the records through field:
+        song, artist, album, publisher or songbook.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        track_ids = []
+        ids = list(ids)
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(table.id,
+                    where=In(getattr(table, field), sub_ids)))
+            track_ids.extend(r[0] for r in cursor.fetchall())
+        if track_ids:
+            cls.refresh(track_ids)
+
+
+class CatalogDeletion(ModelSQL):
+    "Songbook Catalog Deletion"
+    __name__ = 'songbook.catalog.deletion'
+    # Track codes removed from a songbook, with the catalog version of the
+    # songbook after the removal, for the delta exports and the catalog
+    # dumps. A code may be logged and then added again, so only the codes
+    # missing from the catalog count.
+
+    songbook = fields.Many2One('songbook.songbook', 'Songbook', required=True,
+        select=True, ondelete='CASCADE')
+    code = fields.Char('Code', required=True)
+    version = fields.Integer('Version', readonly=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(CatalogDeletion, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        table.index_action(['songbook', 'version'], 'add')
+
+    @classmethod
+    def log(cls, keys, versions):
+        """
+        Log the removal of the (songbook id, track code) keys with the
+        catalog versions by songbook id
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        keys = sorted(keys)
+        if keys:
+            cursor.execute(*table.insert(
+                    [table.create_uid, table.create_date,
+                        table.songbook, table.code, table.version],
+                    [[Transaction().user, Now(), songbook, code,
+                            versions[songbook]]
+                        for songbook, code in keys]))
+
+    @staticmethod
+    def retention():
+        """
+        Return the time the deletions are kept for the catalog dumps, the
+        songbook_deletion_retention option in days
+        """
+        return datetime.timedelta(
+            days=int(CONFIG.get('songbook_deletion_retention', 30)))
+
+
+class RebuildCatalogStart(ModelView):
+    "Rebuild Songbook Catalog"
+    __name__ = 'songbook.catalog.rebuild.start'
+
+
+class RebuildCatalog(Wizard):
+    "Rebuild Songbook Catalog"
+    __name__ = 'songbook.catalog.rebuild'
+
+    start = StateView(
+        'songbook.catalog.rebuild.start',
+        'songbook.catalog_rebuild_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Rebuild', 'rebuild', 'tryton-ok', default=True),
+        ]
+    )
+    rebuild = StateTransition()
+
+    def transition_rebuild(self):
+        Catalog = Pool().get('songbook.catalog')
+        Catalog.rebuild()
+        return 'end'
+
+
+class CheckStatisticsStart(ModelView):
+    "Check Songbook Statistics"
+    __name__ = 'songbook.catalog.check_statistics.start'
+
+    errors = fields.Text('Errors', readonly=True)
+
+    @staticmethod
+    def default_errors():
+        Catalog = Pool().get('songbook.catalog')
+        return '\n'.join('%s,%s %s: %s instead of %s' % error
+            for error in Catalog.check_statistics())
+
+
+class CheckStatistics(Wizard):
+    "Check Songbook Statistics"
+    __name__ = 'songbook.catalog.check_statistics'
+
+    start = StateView(
+        'songbook.catalog.check_statistics.start',
+        'songbook.catalog_check_statistics_start_view_form', [
+            Button('Close', 'end', 'tryton-cancel'),
+            Button('Recompute', 'rebuild', 'tryton-ok', default=True),
+        ]
+    )
+    rebuild = StateTransition()
+
+    def transition_rebuild(self):
+        Catalog = Pool().get('songbook.catalog')
+        Catalog.rebuild_statistics()
+        return 'end'
@@ -0,0 +1,92 @@
+import re
+from bisect import bisect_left
+from itertools import islice
+
+from trytond.config import CONFIG
+
+__all__ = ['PrefixIndex']
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    "Return the lower case words of text"
+    if not text:
+        return []
+    return _WORD.findall(text.lower())
+
+
+class PrefixIndex(object):
+    """
+    In-memory index answering word prefix searches over a fixed list of
+    entries.
+
+    Entries are (payload, texts) tuples given in the order results must be
+    returned, texts being a dictionary of field name and text to index.
+    A query matches an entry when every word of the query text of a field
+    is the prefix of a word of the entry text for that field.
+    """
+
+    def __init__(self, payloads, tokens):
+        self.payloads = payloads
+        self.tokens = tokens
+
+    @staticmethod
+    def enabled():
+        return bool(CONFIG.get('songbook_prefix_index', False))
+
+    @classmethod
+    def build(cls, entries, max_tokens=None):
+        """
+        Build the index from entries.
+        Return None if the entries hold more than max_tokens words.
+        """
+        if max_tokens is None:
+            max_tokens = int(CONFIG.get('songbook_prefix_index_size',
+                    1000000))
+        payloads = []
+        tokens = []
+        for position, (payload, texts) in enumerate(entries):
+            payloads.append(payload)
+            for field, text in texts.iteritems():
+                for word in set(tokenize(text)):
+                    tokens.append((field, word, position))
+            if len(tokens) > max_tokens:
+                return None
+        tokens.sort()
+        return cls(payloads, tokens)
+
+    def _match(self, field, prefix):
+        positions = set()
+        i = bisect_left(self.tokens, (field, prefix))
+        while i < len(self.tokens):
+            token_field, word, position = self.tokens[i]
+            if token_field != field or not word.startswith(prefix):
+                break
+            positions.add(position)
+            i += 1
+        return positions
+
+    def search(self, query, limit, predicate=None):
+        """
+        Return at most limit payloads matching the query, a dictionary of
+        field name and text, and the optional predicate on payloads.
+        """
+        matches = None
+        for field, text in query.iteritems():
+            for word in tokenize(text):
+                positions = self._match(field, word)
+                if matches is None:
+                    matches = positions
+                else:
+                    matches &= positions
+                if not matches:
+                    return []
+        if matches is None:
+            positions = xrange(len(self.payloads))
+        else:
+            positions = sorted(matches)
+        payloads = (self.payloads[p] for p in positions)
+        if predicate:
+            payloads = (p for p in payloads if predicate(p))
+        return list(islice(payloads, limit))
@@ -0,0 +1,303 @@
+import datetime
+import logging
+import threading
+import traceback
+from tempfile import SpooledTemporaryFile
+
+from trytond.config import CONFIG
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from sql.functions import Now
+
+from .songbook import EXPORT_SPOOL_SIZE
+
+__all__ = ['ExportJob', 'ExportJobSongbook']
+
+logger = logging.getLogger('songbook.export_job')
+
+# Seconds between two searches of queued jobs and number of empty searches
+# before the worker stops
+EXPORT_JOB_POLL = 2
+EXPORT_JOB_RETRIES = 3
+
+
+class ExportJob(ModelSQL, ModelView):
+    "Songbook Export Job"
+    __name__ = 'songbook.export.job'
+    # Track exports run by an ExportWorker thread of the server process
+    # instead of the wizard request. The file is attached to the songbooks.
+
+    user = fields.Many2One('res.user', 'User', required=True, readonly=True)
+    songbooks = fields.Many2Many('songbook.export.job-songbook.songbook',
+        'job', 'songbook', 'Songbooks', readonly=True)
+    mode = fields.Selection([
+            ('full', 'All Tracks'),
+            ('delta', 'Changes Since Last Delta Export'),
+            ], 'Mode', required=True, readonly=True)
+    state = fields.Selection([
+            ('queued', 'Queued'),
+            ('running', 'Running'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+            ], 'State', required=True, readonly=True, select=True)
+    index = fields.Boolean('Track Code Index', readonly=True)
+    total = fields.Integer('Total Lines', readonly=True)
+    progress = fields.Integer('Exported Lines', readonly=True)
+    attachment = fields.Many2One('ir.attachment', 'File', readonly=True,
+        ondelete='SET NULL')
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ExportJob, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @staticmethod
+    def default_user():
+        return Transaction().user
+
+    @staticmethod
+    def default_mode():
+        return 'full'
+
+    @staticmethod
+    def default_state():
+        return 'queued'
+
+    @staticmethod
+    def default_index():
+        return False
+
+    @staticmethod
+    def default_progress():
+        return 0
+
+    @staticmethod
+    def timeout():
+        """
+        Return the time without progress after which a running job is
+        failed, the songbook_export_job_timeout option in seconds
+        """
+        return datetime.timedelta(
+            seconds=int(CONFIG.get('songbook_export_job_timeout', 3600)))
+
+    @classmethod
+    def create(cls, vlist):
+        jobs = super(ExportJob, cls).create(vlist)
+        # The jobs are only visible to the worker once committed, those it
+        # misses are found by run_queued
+        ExportWorker.wake(Transaction().cursor.database_name)
+        return jobs
+
+    @classmethod
+    def run_queued(cls):
+        """
+        Fail the running jobs without progress for the timeout, as their
+        worker stopped, and wake the worker when jobs are queued. Called
+        periodically by a scheduled action.
+        """
+        timeout = cls.timeout()
+        stale = cls.search([
+                ('state', '=', 'running'),
+                ('write_date', '<', datetime.datetime.now() - timeout),
+                ])
+        if stale:
+            cls.fail(stale, 'No progress for %s seconds, the export was '
+                'interrupted.' % int(timeout.total_seconds()))
+        if cls.search([('state', '=', 'queued')], limit=1):
+            ExportWorker.wake(Transaction().cursor.database_name)
+
+    @classmethod
+    def fail(cls, jobs, error):
+        "Mark the jobs as failed with the error"
+        cls.write(jobs, {
+                'state': 'failed',
+                'error': error,
+                })
+
+    @classmethod
+    def claim(cls):
+        "Mark the oldest queued job as running and return its id or None"
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        while True:
+            cursor.execute(*table.select(table.id,
+                    where=table.state == 'queued',
+                    order_by=[table.id.asc], limit=1))
+            row = cursor.fetchone()
+            if not row:
+                return None
+            # Another process may have claimed it in the meantime
+            cursor.execute(*table.update([table.state, table.write_date],
+                    ['running', Now()],
+                    where=(table.id == row[0]) & (table.state == 'queued')))
+            if cursor.rowcount:
+                return row[0]
+
+    def set_progress(self, count, total=None):
+        """
+        Store the number of exported lines, and the total if given, in a
+        separate transaction so that they are visible during the export and
+        the job is not taken for interrupted. SQLite can not commit it while
+        the export reads, so only the total is stored there.
+        """
+        if total is None and CONFIG['db_type'] == 'sqlite':
+            return
+        table = self.__table__()
+        columns, values = [table.progress, table.write_date], [count, Now()]
+        if total is not None:
+            columns.append(table.total)
+            values.append(total)
+        with Transaction().new_cursor():
+            cursor = Transaction().cursor
+            cursor.execute(*table.update(columns, values,
+                    where=table.id == self.id))
+            cursor.commit()
+
+    def export(self):
+        """
+        Write the tracks of the songbooks and attach the file, and the track
+        code index if asked, to each of them. Return the attachment of the
+        file of the first songbook.
+        """
+        pool = Pool()
+        Catalog = pool.get('songbook.catalog')
+        Attachment = pool.get('ir.attachment')
+        ExportTracks = pool.get('songbook.songbook.export_tracks',
+            type='wizard')
+
+        songbook_ids = [s.id for s in self.songbooks]
+        if self.mode == 'full':
+            self.set_progress(0, total=Catalog.search([
+                        ('songbook', 'in', songbook_ids),
+                        ], count=True))
+        with SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as file_:
+            if self.mode == 'delta':
+                watermarks = ExportTracks.delta_watermarks(songbook_ids)
+                count = ExportTracks.write_delta(file_, watermarks,
+                    progress=self.set_progress)
+            else:
+                count = ExportTracks.write_tracks(file_, songbook_ids,
+                    progress=self.set_progress)
+            file_.seek(0)
+            data = file_.read()
+        attachments = Attachment.create([{
+                    'name': 'tracks-%s.txt' % self.id,
+                    'resource': str(songbook),
+                    'data': buffer(data),
+                    } for songbook in self.songbooks])
+        if self.mode == 'full' and self.index:
+            with SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as file_:
+                ExportTracks.write_index(file_, songbook_ids)
+                file_.seek(0)
+                data = file_.read()
+            Attachment.create([{
+                        'name': 'tracks-%s.sbkx' % self.id,
+                        'resource': str(songbook),
+                        'data': buffer(data),
+                        } for songbook in self.songbooks])
+        if self.mode == 'delta':
+            # Delivered with the attachments
+            ExportTracks.confirm_delta(watermarks)
+        # Only the songbook administrators may write the jobs
+        with Transaction().set_user(0):
+            self.write([self], {
+                    'state': 'done',
+                    'progress': count,
+                    'attachment': attachments[0].id,
+                    })
+        return attachments[0]
+
+    @classmethod
+    def run(cls, database_name, job_id):
+        "Run the job in its own transaction as the user who queued it"
+        pool = Pool(database_name)
+        try:
+            with Transaction().start(database_name, 0):
+                User = pool.get('res.user')
+                user = cls(job_id).user.id
+                with Transaction().set_user(user):
+                    context = User.get_preferences(context_only=True)
+
+            with Transaction().start(database_name, user,
+                    context=context) as transaction:
+                try:
+                    cls(job_id).export()
+                    transaction.cursor.commit()
+                    return
+                except Exception:
+                    transaction.cursor.rollback()
+                    raise
+        except Exception:
+            error = traceback.format_exc()
+            logger.exception('export job %s failed', job_id)
+
+        with Transaction().start(database_name, 0) as transaction:
+            cls.fail([cls(job_id)], error)
+            transaction.cursor.commit()
+
+
+class ExportJobSongbook(ModelSQL):
+    "Songbook Export Job - Songbook"
+    __name__ = 'songbook.export.job-songbook.songbook'
+
+    job = fields.Many2One('songbook.export.job', 'Job', required=True,
+        select=True, ondelete='CASCADE')
+    songbook = fields.Many2One('songbook.songbook', 'Songbook',
+        required=True, select=True, ondelete='CASCADE')
+
+
+class ExportWorker(threading.Thread):
+    """
+    Thread running the queued export jobs of a database.
+    It is started when a job is created or by ExportJob.run_queued and stops
+    once no job has been found for EXPORT_JOB_RETRIES searches.
+    """
+    _workers = {}
+    _lock = threading.Lock()
+
+    def __init__(self, database_name):
+        super(ExportWorker, self).__init__(
+            name='songbook-export-%s' % database_name)
+        self.daemon = True
+        self.database_name = database_name
+        self.event = threading.Event()
+
+    @classmethod
+    def wake(cls, database_name):
+        with cls._lock:
+            worker = cls._workers.get(database_name)
+            if worker is None:
+                worker = cls._workers[database_name] = cls(database_name)
+                worker.start()
+            worker.event.set()
+
+    def run_next(self):
+        "Run the next queued job and return whether there was one"
+        pool = Pool(self.database_name)
+        with Transaction().start(self.database_name, 0) as transaction:
+            job_id = pool.get('songbook.export.job').claim()
+            transaction.cursor.commit()
+        if job_id is None:
+            return False
+        pool.get('songbook.export.job').run(self.database_name, job_id)
+        return True
+
+    def run(self):
+        idle = 0
+        while True:
+            try:
+                found = self.run_next()
+            except Exception:
+                logger.exception('export worker of %s', self.database_name)
+                found = False
+            idle = 0 if found else idle + 1
+            if idle >= EXPORT_JOB_RETRIES:
+                with self._lock:
+                    if not self.event.is_set():
+                        del self._workers[self.database_name]
+                        return
+            if not found:
+                self.event.wait(EXPORT_JOB_POLL)
+            self.event.clear()
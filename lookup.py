@@ -0,0 +1,139 @@
+import mmap
+import os
+import struct
+from tempfile import SpooledTemporaryFile
+from threading import Lock
+
+from trytond.config import CONFIG
+
+__all__ = ['TrackIndex']
+
+MAGIC = 'SBKX'
+VERSION = 2
+# Magic, version, size of an entry and number of entries
+_HEADER = struct.Struct('<4sHHI')
+# Offset in the string table of the code, followed by the title and the
+# artist, and the lengths of the three UTF-8 encoded strings
+_ENTRY = struct.Struct('<IIII')
+# Largest offset, length and number of entries of the format
+_MAX = 0xffffffff
+_SPOOL_SIZE = 4 * 1024 * 1024
+
+
+class TrackIndex(object):
+    """
+    Compact index of the title and artist of the tracks by code.
+
+    The file starts with a header (the SBKX magic, the format version, the
+    size of an entry and the number of entries, little-endian) followed by
+    the fixed-width entries sorted by the UTF-8 bytes of the code and by the
+    string table the entries point to. A code is found by a binary search
+    on the entries, directly in a memory-mapped file.
+    """
+    _served = None
+    _served_lock = Lock()
+
+    def __init__(self, data):
+        self.data = data
+        magic, version, entry_size, self.count = _HEADER.unpack_from(data)
+        if (magic != MAGIC or version != VERSION
+                or entry_size != _ENTRY.size):
+            raise ValueError('Not a track code index')
+        self.strings = _HEADER.size + self.count * _ENTRY.size
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def write(cls, file_, rows):
+        """
+        Write the index of the (code, title, artist) rows to file_ and
+        return the number of entries. Raise ValueError, before writing to
+        file_, if the strings or the entries do not fit the 32-bit offsets
+        and counts of the format.
+        """
+        entries = []
+        offset = 0
+        with SpooledTemporaryFile(max_size=_SPOOL_SIZE) as strings:
+            for code, title, artist in rows:
+                values = [(v or u'').encode('utf-8')
+                    for v in (code, title, artist)]
+                size = sum(len(v) for v in values)
+                if offset + size > _MAX:
+                    raise ValueError('The strings of the track code index '
+                        'exceed %s bytes' % _MAX)
+                if len(entries) >= _MAX:
+                    raise ValueError('The track code index exceeds %s '
+                        'entries' % _MAX)
+                strings.write(''.join(values))
+                entries.append((values[0], offset, len(values[0]),
+                        len(values[1]), len(values[2])))
+                offset += size
+            # Sorting is stable so the tracks of a code keep the row order
+            entries.sort(key=lambda e: e[0])
+            file_.write(_HEADER.pack(MAGIC, VERSION, _ENTRY.size,
+                    len(entries)))
+            for entry in entries:
+                file_.write(_ENTRY.pack(*entry[1:]))
+            strings.seek(0)
+            while True:
+                data = strings.read(_SPOOL_SIZE)
+                if not data:
+                    break
+                file_.write(data)
+        return len(entries)
+
+    def _entry(self, i):
+        return _ENTRY.unpack_from(self.data, _HEADER.size + i * _ENTRY.size)
+
+    def _code(self, i):
+        offset, length = self._entry(i)[:2]
+        start = self.strings + offset
+        return self.data[start:start + length]
+
+    def lookup(self, code):
+        "Return the (title, artist) of the tracks with the code"
+        code = code.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._code(middle) < code:
+                low = middle + 1
+            else:
+                high = middle
+        result = []
+        while low < self.count and self._code(low) == code:
+            offset, code_length, title_length, artist_length = \
+                self._entry(low)
+            start = self.strings + offset + code_length
+            title = self.data[start:start + title_length]
+            artist = self.data[start + title_length:
+                start + title_length + artist_length]
+            result.append((title.decode('utf-8'), artist.decode('utf-8')))
+            low += 1
+        return result
+
+    @classmethod
+    def open(cls, path):
+        "Return the index of the file at path, memory-mapped"
+        with open(path, 'rb') as file_:
+            return cls(mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def served(cls):
+        """
+        Return the index of the file set by the songbook_lookup_index option
+        or None. The file is mapped again when it is replaced.
+        """
+        path = CONFIG.get('songbook_lookup_index')
+        if not path:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = (path, stat.st_ino, stat.st_mtime, stat.st_size)
+        with cls._served_lock:
+            if cls._served is None or cls._served[0] != key:
+                cls._served = (key, cls.open(path))
+            return cls._served[1]
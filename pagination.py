@@ -0,0 +1,165 @@
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+from werkzeug.utils import cached_property
+from nereid.contrib.pagination import BasePagination
+
+__all__ = ['KeysetPagination']
+
+# The types of the key values a cursor may hold
+SCALARS = (basestring, int, long, float)
+
+
+class KeysetPagination(BasePagination):
+    """
+    Paginator seeking past the sort key of the last (or first) record of
+    the previous page instead of using OFFSET, so that any page costs the
+    same as the first one.
+
+    Pages are addressed by opaque cursors (next_cursor and prev_cursor)
+    rather than by page numbers. The records are ordered by the keys, which
+    must not be NULL, followed by id. Counting all the records is only done
+    when count is True.
+    """
+
+    def __init__(self, obj, domain, keys, per_page, cursor=None,
+            count=False):
+        """
+        :param obj: The model to paginate
+        :param domain: Domain for search in tryton
+        :param keys: The names of the fields to order by
+        :param per_page: Items per page
+        :param cursor: The cursor of the page to display, None for the first
+        :param count: Whether to count the records matching the domain
+        """
+        self.obj = obj
+        self.domain = domain
+        self.keys = list(keys) + ['id']
+        self.cursor = cursor
+        self.with_count = count
+        super(KeysetPagination, self).__init__(1, per_page)
+
+    @staticmethod
+    def encode_cursor(direction, values):
+        return urlsafe_b64encode(json.dumps([direction, values]))
+
+    @staticmethod
+    def decode_cursor(cursor, length=None):
+        """
+        Return the direction and the key values of the cursor.
+        An invalid cursor, or one without length scalar values when length
+        is set, points to the first page.
+        """
+        if not cursor:
+            return None, None
+        try:
+            direction, values = json.loads(urlsafe_b64decode(str(cursor)))
+        except (TypeError, ValueError):
+            return None, None
+        if direction not in ('after', 'before'):
+            return None, None
+        if (not isinstance(values, list)
+                or (length is not None and len(values) != length)
+                or not all(v is None or isinstance(v, SCALARS)
+                    for v in values)):
+            return None, None
+        return direction, values
+
+    def _seek_domain(self, values, operator):
+        domain = ['OR']
+        for i, key in enumerate(self.keys):
+            clause = [(k, '=', v) for k, v in zip(self.keys[:i], values[:i])]
+            clause.append((key, operator, values[i]))
+            domain.append(clause)
+        return domain
+
+    def _key_values(self, record):
+        return [getattr(record, k) for k in self.keys]
+
+    @cached_property
+    def _page(self):
+        direction, values = self.decode_cursor(self.cursor, len(self.keys))
+        domain = self.domain
+        order = [(k, 'ASC') for k in self.keys]
+        if direction == 'after':
+            domain = [self.domain, self._seek_domain(values, '>')]
+        elif direction == 'before':
+            domain = [self.domain, self._seek_domain(values, '<')]
+            order = [(k, 'DESC') for k in self.keys]
+        records = self.obj.search(
+            domain, limit=self.per_page + 1, order=order
+        )
+        more = len(records) > self.per_page
+        records = records[:self.per_page]
+        if direction == 'before':
+            records.reverse()
+            has_prev, has_next = more, True
+        else:
+            has_prev, has_next = direction == 'after', more
+        return records, has_prev, has_next
+
+    def items(self):
+        """
+        Returns the list of browse records of items in the page
+        """
+        return self._page[0]
+
+    def all_items(self):
+        """Returns complete set of items"""
+        return self.obj.search(
+            self.domain, order=[(k, 'ASC') for k in self.keys]
+        )
+
+    @cached_property
+    def count(self):
+        """
+        Returns the count of entries or None if it was not requested
+        """
+        if not self.with_count:
+            return None
+        return self.obj.search(domain=self.domain, count=True)
+
+    @property
+    def pages(self):
+        if self.count is None:
+            return None
+        return super(KeysetPagination, self).pages
+
+    has_prev = property(lambda self: self._page[1])
+    has_next = property(lambda self: self._page[2])
+
+    @property
+    def prev_cursor(self):
+        "The cursor of the previous page or None"
+        if not self.has_prev or not self.items():
+            return None
+        return self.encode_cursor(
+            'before', self._key_values(self.items()[0])
+        )
+
+    @property
+    def next_cursor(self):
+        "The cursor of the next page or None"
+        if not self.has_next or not self.items():
+            return None
+        return self.encode_cursor(
+            'after', self._key_values(self.items()[-1])
+        )
+
+    def serialize(self):
+        if hasattr(self.obj, 'serialize_many'):
+            items = self.obj.serialize_many(self.items())
+        else:
+            items = [
+                {
+                    'id': item.id,
+                    'rec_name': item.rec_name,
+                } for item in self.items()
+            ]
+        return {
+            "count": self.count,
+            "per_page": self.per_page,
+            "prev_cursor": self.prev_cursor,
+            "next_cursor": self.next_cursor,
+            "items": items,
+        }
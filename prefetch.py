@@ -0,0 +1,81 @@
+__all__ = ['prefetch']
+
+_RELATIONS = ('many2one', 'one2one', 'one2many', 'many2many')
+
+
+def _tree(paths):
+    "Return the nested dictionary of the field names of the dotted paths"
+    tree = {}
+    for path in paths:
+        node = tree
+        for name in path.split('.'):
+            node = node.setdefault(name, {})
+    return tree
+
+
+def _load(Model, ids, tree):
+    """
+    Return the records of Model with the ids, their eager fields and the
+    fields of tree read beforehand with one read for all of them, and the
+    records of the paths of tree below them loaded the same way, level by
+    level. The other fields are read on access with the siblings of the
+    record, like for browsed records.
+    """
+    records = Model.browse(ids)
+    if not records:
+        return []
+
+    names = [name for name, field in Model._fields.iteritems()
+        if name != 'id' and (name in tree
+            or (field.loading == 'eager' and field._type not in (
+                    'one2many', 'many2many')))]
+    rows = Model.read(ids, names)
+
+    targets = {}
+    for name in names:
+        field = Model._fields[name]
+        if field._type not in _RELATIONS:
+            continue
+        target_ids = set()
+        for row in rows:
+            value = row[name]
+            if isinstance(value, (list, tuple)):
+                target_ids.update(value)
+            elif value is not None:
+                target_ids.add(value)
+        target_ids = sorted(target_ids)
+        Target = field.get_target()
+        if name in tree:
+            loaded = _load(Target, target_ids, tree[name])
+        else:
+            # Not prefetched, read with its siblings when accessed
+            loaded = Target.browse(target_ids)
+        targets[name] = dict((r.id, r) for r in loaded)
+
+    rows = dict((row['id'], row) for row in rows)
+    for record in records:
+        row = rows[record.id]
+        for name in names:
+            value = row[name]
+            if name in targets:
+                if isinstance(value, (list, tuple)):
+                    value = [targets[name][i] for i in value]
+                elif value is not None:
+                    value = targets[name][value]
+            setattr(record, name, value)
+    return records
+
+
+def prefetch(records, paths):
+    """
+    Return new instances of the records whose fields, and the fields of the
+    records reached through each dotted path of many2one and one2many fields
+    (like 'albums.tracks.song.artist'), are read beforehand with one read
+    per level. Accessing them afterwards, for example in a template, runs no
+    query whatever the number of records. The last name of a path may be a
+    function field, read with the records of its level.
+    """
+    if not records:
+        return []
+    Model = records[0].__class__
+    return _load(Model, [r.id for r in records], _tree(paths))
@@ -0,0 +1,125 @@
+import logging
+import re
+import time
+from collections import Counter
+from functools import wraps
+
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+from nereid import current_app
+from nereid.ctx import has_request_context
+from nereid.templating import LazyRenderer
+
+__all__ = ['QueryRecorder', 'profiled']
+
+logger = logging.getLogger('songbook.profiling')
+
+_PLACEHOLDERS = re.compile(r'(%s|\?)(\s*,\s*(%s|\?))+')
+_NUMBERS = re.compile(r'\b\d+\b')
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+
+
+def statement_shape(sql):
+    """
+    Return the statement with its literals and the length of its parameter
+    lists removed so that statements differing only by values compare equal.
+    """
+    sql = _STRINGS.sub('?', sql)
+    sql = _NUMBERS.sub('?', sql)
+    sql = sql.replace('%s', '?')
+    return _PLACEHOLDERS.sub('?, ...', sql)
+
+
+class QueryRecorder(object):
+    """
+    Record the SQL statements executed on the cursor of the transaction
+    while used as a context manager. The statements and their parameters are
+    kept in statements when keep is True.
+    """
+
+    def __init__(self, name, keep=False):
+        self.name = name
+        self.count = 0
+        self.duration = 0.
+        self.shapes = Counter()
+        self.keep = keep
+        self.statements = []
+
+    @staticmethod
+    def enabled():
+        return bool(CONFIG.get('songbook_profile', False))
+
+    @staticmethod
+    def threshold():
+        "The number of runs of a statement above which it is reported as N+1"
+        return int(CONFIG.get('songbook_profile_threshold', 10))
+
+    def __enter__(self):
+        self.cursor = Transaction().cursor
+        execute = self.cursor.execute
+
+        def recorded_execute(sql, params=None):
+            start = time.time()
+            try:
+                return execute(sql, params)
+            finally:
+                self.count += 1
+                self.duration += time.time() - start
+                self.shapes[statement_shape(sql)] += 1
+                if self.keep:
+                    self.statements.append((sql, params))
+        self.cursor.execute = recorded_execute
+        return self
+
+    def __exit__(self, type, value, traceback):
+        del self.cursor.execute
+        del self.cursor
+
+    def top(self, number=5):
+        "Return the most executed statement shapes with their count"
+        return self.shapes.most_common(number)
+
+    def repeated(self, threshold=None):
+        "Return the statement shapes run more than threshold times"
+        if threshold is None:
+            threshold = self.threshold()
+        return [(s, c) for s, c in self.shapes.most_common() if c > threshold]
+
+    def summary(self):
+        return 'queries=%d; time=%.1fms; repeated=%d' % (
+            self.count, self.duration * 1000, len(self.repeated()))
+
+    def log(self):
+        logger.info('%s: %s', self.name, self.summary())
+        for shape, count in self.top():
+            logger.debug('%s: %d x %s', self.name, count, shape)
+        for shape, count in self.repeated():
+            logger.warning('%s: possible N+1, %d x %s',
+                self.name, count, shape)
+
+
+def profiled(func):
+    """
+    Record the queries of the decorated method when the songbook_profile
+    option is set and log them. The response of a route is rendered before
+    the recording stops and gets an X-Songbook-SQL header with the summary.
+    """
+    @wraps(func)
+    def wrapper(cls_or_self, *args, **kwargs):
+        cursor = Transaction().cursor
+        if (not QueryRecorder.enabled()
+                or 'execute' in getattr(cursor, '__dict__', {})):
+            return func(cls_or_self, *args, **kwargs)
+        name = '%s.%s' % (cls_or_self.__name__, func.__name__)
+        is_route = hasattr(wrapper, '_url_rules') and has_request_context()
+        with QueryRecorder(name) as recorder:
+            result = func(cls_or_self, *args, **kwargs)
+            if is_route:
+                if isinstance(result, LazyRenderer):
+                    result = (unicode(result), result.status, result.headers)
+                result = current_app.make_response(result)
+        recorder.log()
+        if is_route:
+            result.headers['X-Songbook-SQL'] = recorder.summary()
+        return result
+    return wrapper
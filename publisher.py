@@ -1,6 +1,8 @@
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pool import Pool
 
+from .responsecache import response_cache
+
 __all__ = ['Publisher']
 
 
@@ -16,6 +18,12 @@ class Publisher(ModelSQL, ModelView):
         'publisher',
         'Albums from This Publisher'
     )
+    # Statistics maintained by the catalog
+    album_count = fields.Integer('Albums', readonly=True)
+    track_count = fields.Integer('Tracks', readonly=True)
+    song_count = fields.Integer('Songs', readonly=True)
+    artist_count = fields.Integer('Artists', readonly=True)
+    stats_date = fields.Timestamp('Statistics Changed', readonly=True)
 
     @classmethod
     def __setup__(cls):
@@ -26,3 +34,25 @@ class Publisher(ModelSQL, ModelView):
         ]
         cls._order.insert(0, ('name', 'ASC'))
 
+    @staticmethod
+    def default_album_count():
+        return 0
+
+    @staticmethod
+    def default_track_count():
+        return 0
+
+    @staticmethod
+    def default_song_count():
+        return 0
+
+    @staticmethod
+    def default_artist_count():
+        return 0
+
+    @classmethod
+    def write(cls, publishers, values):
+        Catalog = Pool().get('songbook.catalog')
+        super(Publisher, cls).write(publishers, values)
+        Catalog.refresh_for('publisher', [p.id for p in publishers])
+        response_cache.clear()
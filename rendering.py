@@ -0,0 +1,407 @@
+import cPickle
+import datetime
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from contextlib import closing
+from hashlib import md5
+try:
+    import cStringIO as StringIO
+except ImportError:
+    import StringIO
+
+import lxml.etree
+import relatorio.reporting
+from genshi.filters import Translator
+from sql.aggregate import Max
+from sql.conditionals import Coalesce
+try:
+    from relatorio.templates.opendocument import Manifest, MANIFEST
+except ImportError:
+    Manifest, MANIFEST = None, None
+
+from trytond.config import CONFIG
+from trytond.pool import Pool
+from trytond.report import Report, ReportFactory, MIMETYPES, FORMAT2EXT
+from trytond.rpc import RPC
+from trytond.transaction import Transaction
+
+__all__ = ['Lookup', 'ParallelReport']
+
+
+class Lookup(dict):
+    """
+    Dictionary of values by record id, called by the templates like a
+    function. Unlike a lambda it can be sent to the rendering processes.
+    """
+    __call__ = dict.__getitem__
+
+
+class _Record(object):
+    "Plain copy of the fields of a record read by the templates"
+
+    def __init__(self, values):
+        self.__dict__.update(values)
+
+
+def _render(args):
+    "Render a template in a rendering process and return the document"
+    path, mimetype, translations, template_extension, output_format, \
+        localcontext = args
+    rel_report = relatorio.reporting.Report(path, mimetype,
+        ReportFactory(), relatorio.reporting.MIMETemplateLoader())
+    rel_report.filters.insert(0,
+        Translator(lambda text: translations.get(text, text)))
+    localcontext['StringIO'] = StringIO.StringIO
+    localcontext['time'] = time
+    localcontext['datetime'] = datetime
+    data = rel_report(**localcontext).render()
+    if hasattr(data, 'getvalue'):
+        data = data.getvalue()
+    if output_format not in MIMETYPES:
+        data = Report.unoconv(data, template_extension, output_format)
+    return data
+
+
+def _render_main(output):
+    """
+    Render the tasks pickled on the standard input with the options of the
+    server and pickle the documents into the file output
+    """
+    options, tasks = cPickle.load(sys.stdin)
+    for key, value in options.iteritems():
+        CONFIG[key] = value
+    documents = [_render(task) for task in tasks]
+    with open(output, 'wb') as file_:
+        cPickle.dump(documents, file_, cPickle.HIGHEST_PROTOCOL)
+
+
+class ParallelReport(Report):
+    """
+    Report rendering one document per record in separate processes when
+    more than one record is printed and the songbook_report_processes option
+    (or the processes key of data) is above 1. The documents are returned
+    in a zip file. The processes are new interpreters rather than forks of
+    the server, so that they inherit neither its database connections nor
+    the locks of its threads.
+    The data are gathered in the transaction, so the values put in the
+    local context must be picklable: use Lookup instead of functions.
+    The templates get the record_fields of the records instead of the
+    records and neither user nor formatLang.
+
+    When the model has a get_fingerprints method, returning a fingerprint of
+    the content of each record, the document of each record is stored as an
+    attachment of the record named after the report, the language and a
+    digest of the fingerprint and of the template. Printing it again returns
+    the attachment without reading the records, and storing a new document
+    deletes the former ones. Several records are cached only when rendered
+    in parallel, as a document per record.
+    """
+    record_fields = ['rec_name']
+
+    @classmethod
+    def __setup__(cls):
+        super(ParallelReport, cls).__setup__()
+        # Printing stores the documents in the cache
+        cls.__rpc__['execute'] = RPC(readonly=False)
+
+    @staticmethod
+    def processes(data):
+        return int((data or {}).get('processes',
+                CONFIG.get('songbook_report_processes', 0)) or 0)
+
+    @classmethod
+    def execute(cls, ids, data):
+        pool = Pool()
+        ActionReport = pool.get('ir.action.report')
+
+        action_reports = ActionReport.search([
+                ('report_name', '=', cls.__name__),
+                ])
+        if (not CONFIG.get('songbook_report_cache', False)
+                or not action_reports or not action_reports[0].model
+                or not ids or (len(ids) > 1 and cls.processes(data) <= 1)):
+            return super(ParallelReport, cls).execute(ids, data)
+        report = action_reports[0]
+        Model = pool.get(report.model)
+        if not hasattr(Model, 'get_fingerprints'):
+            return super(ParallelReport, cls).execute(ids, data)
+
+        # The cache is read as root, so check the access of the user first
+        Model.read(ids, ['id'])
+        names = cls.cache_names(report, Model.get_fingerprints(ids))
+        documents = cls.get_cached(report.model, names)
+        missing = [i for i in ids if i not in documents]
+        if missing:
+            records = cls._get_records(missing, report.model, data)
+            _, content = cls.parse(report, records, data, {})
+            if len(missing) == 1:
+                rendered = [content]
+            else:
+                with closing(zipfile.ZipFile(
+                            StringIO.StringIO(content))) as archive:
+                    rendered = [archive.read(i) for i in archive.infolist()]
+            rendered = dict(zip(missing, rendered))
+            cls.set_cached(report.model, names, rendered)
+            documents.update(rendered)
+
+        output_format = report.extension or report.template_extension
+        oext = FORMAT2EXT.get(output_format, output_format)
+        if len(ids) == 1:
+            type_, content = oext, documents[ids[0]]
+        else:
+            records = Model.read(ids, cls.record_fields)
+            type_, content = 'zip', cls.zip_documents(
+                [r[cls.record_fields[0]] for r in records],
+                [documents[i] for i in ids], oext)
+        return (type_, buffer(content), report.direct_print, report.name)
+
+    @classmethod
+    def parse(cls, report, objects, data, localcontext):
+        processes = cls.processes(data)
+        if processes > 1 and objects and len(objects) > 1:
+            return cls.parse_parallel(report, objects, data, localcontext,
+                processes)
+        return super(ParallelReport, cls).parse(report, objects, data,
+            localcontext)
+
+    @classmethod
+    def parse_parallel(cls, report, objects, data, localcontext, processes):
+        pool = Pool()
+        Model = pool.get(report.model)
+
+        records = Model.read([o.id for o in objects], cls.record_fields)
+        path = cls.template_file(report)
+        translations = cls.get_translations()
+        output_format = report.extension or report.template_extension
+        localcontext['data'] = data
+        localcontext['context'] = Transaction().context
+        tasks = []
+        for record in records:
+            values = {}
+            for key, value in localcontext.iteritems():
+                if isinstance(value, Lookup):
+                    value = Lookup({record['id']: value[record['id']]})
+                values[str(key)] = value
+            values['objects'] = values['records'] = [_Record(record)]
+            tasks.append((path, MIMETYPES[report.template_extension],
+                    translations, report.template_extension, output_format,
+                    values))
+        workers = min(processes, len(tasks))
+        env = dict(os.environ,
+            PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+        started = []
+        try:
+            for i in range(workers):
+                fd, output = tempfile.mkstemp(prefix='trytond_')
+                os.close(fd)
+                started.append((subprocess.Popen(
+                            [sys.executable, '-m', __name__, output],
+                            stdin=subprocess.PIPE, close_fds=True, env=env),
+                        output))
+            # The tasks are written once all the processes are started to
+            # let them load in parallel
+            options = {'unoconv': CONFIG['unoconv']}
+            for i, (process, _) in enumerate(started):
+                cPickle.dump((options, tasks[i::workers]), process.stdin,
+                    cPickle.HIGHEST_PROTOCOL)
+                process.stdin.close()
+            rendered = []
+            for process, output in started:
+                if process.wait():
+                    raise Exception('Error', 'Report rendering failed!')
+                with open(output, 'rb') as file_:
+                    rendered.append(cPickle.load(file_))
+        finally:
+            for process, output in started:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                os.remove(output)
+            os.remove(path)
+        documents = [rendered[i % workers][i // workers]
+            for i in range(len(tasks))]
+
+        oext = FORMAT2EXT.get(output_format, output_format)
+        return ('zip', cls.zip_documents(
+                [r[cls.record_fields[0]] for r in records], documents, oext))
+
+    @staticmethod
+    def zip_documents(names, documents, extension):
+        "Return a zip file of the documents, in order, named after names"
+        content = StringIO.StringIO()
+        with closing(zipfile.ZipFile(content, 'w',
+                    zipfile.ZIP_DEFLATED)) as archive:
+            for name, document in zip(names, documents):
+                archive.writestr('%s.%s' % (name.replace('/', '-'),
+                        extension), document)
+        return content.getvalue()
+
+    @classmethod
+    def cache_prefix(cls):
+        return '%s-%s-' % (cls.__name__, Transaction().language)
+
+    @classmethod
+    def template_version(cls, report):
+        """
+        Return a digest of the template, the style, the output format and
+        the last change of the translations of the report.
+        """
+        Translation = Pool().get('ir.translation')
+        cursor = Transaction().cursor
+        translation = Translation.__table__()
+
+        cursor.execute(*translation.select(
+                Max(Coalesce(translation.write_date,
+                        translation.create_date)),
+                where=(translation.lang == Transaction().language)
+                & (translation.type == 'odt')
+                & (translation.name == cls.__name__)))
+        last_change, = cursor.fetchone()
+        digest = md5(str(report.report_content or ''))
+        digest.update(str(report.style_content or ''))
+        digest.update('%s:%s' % (report.extension, last_change))
+        return digest.hexdigest()
+
+    @classmethod
+    def cache_names(cls, report, fingerprints):
+        "Return the attachment names of the documents of the records by id"
+        version = cls.template_version(report)
+        output_format = report.extension or report.template_extension
+        oext = FORMAT2EXT.get(output_format, output_format)
+        return dict((id_, '%s%s.%s' % (cls.cache_prefix(),
+                        md5('%s:%s' % (fingerprint, version)).hexdigest(),
+                        oext))
+            for id_, fingerprint in fingerprints.iteritems())
+
+    @classmethod
+    def get_cached(cls, model, names):
+        "Return the cached documents of the records by id"
+        Attachment = Pool().get('ir.attachment')
+        with Transaction().set_user(0):
+            attachments = Attachment.search([
+                    ('resource', 'in',
+                        ['%s,%s' % (model, i) for i in names]),
+                    ('name', 'in', list(set(names.values()))),
+                    ])
+            documents = {}
+            for attachment in attachments:
+                id_ = int(attachment.resource.id)
+                if (names.get(id_) == attachment.name
+                        and attachment.data is not None):
+                    documents[id_] = str(attachment.data)
+        return documents
+
+    @classmethod
+    def set_cached(cls, model, names, documents):
+        """
+        Store the documents of the records by id and delete the former ones
+        in the same language. The records without a name, having no
+        fingerprint, are skipped.
+        """
+        Attachment = Pool().get('ir.attachment')
+        ids = [i for i in documents if i in names]
+        if not ids:
+            return
+        with Transaction().set_user(0):
+            cls.delete_cached(model, ids, cls.cache_prefix())
+            Attachment.create([{
+                        'name': names[id_],
+                        'resource': '%s,%s' % (model, id_),
+                        'data': buffer(documents[id_]),
+                        } for id_ in ids])
+
+    @classmethod
+    def delete_cached(cls, model, ids, prefix=None):
+        """
+        Delete the cached documents of the records whose name starts with
+        prefix, by default those of every language
+        """
+        Attachment = Pool().get('ir.attachment')
+        if prefix is None:
+            prefix = '%s-' % cls.__name__
+        with Transaction().set_user(0):
+            Attachment.delete(Attachment.search([
+                        ('resource', 'in',
+                            ['%s,%s' % (model, i) for i in ids]),
+                        ('name', 'like', '%s%%' % prefix),
+                        ]))
+
+    @classmethod
+    def get_translations(cls):
+        "Return the translations of the template for the current language"
+        Translation = Pool().get('ir.translation')
+        translations = Translation.search([
+                ('lang', '=', Transaction().language),
+                ('type', '=', 'odt'),
+                ('name', '=', cls.__name__),
+                ('value', '!=', ''),
+                ('value', '!=', None),
+                ('fuzzy', '=', False),
+                ('res_id', '=', -1),
+                ])
+        return dict((t.src, t.value) for t in translations)
+
+    @classmethod
+    def template_file(cls, report):
+        """
+        Write the template of the report with its style merged into a
+        temporary file and return its path.
+        """
+        if not report.report_content:
+            raise Exception('Error', 'Missing report file!')
+        content = str(report.report_content)
+        if report.style_content:
+            content = cls.merge_style(content, str(report.style_content))
+        fd, path = tempfile.mkstemp(
+            suffix=(os.extsep + report.template_extension),
+            prefix='trytond_')
+        with os.fdopen(fd, 'wb') as file_:
+            file_.write(content)
+        return path
+
+    @staticmethod
+    def merge_style(content, style_content):
+        """
+        Return the template content with the master and automatic styles
+        and the pictures of style_content.
+        """
+        # Copy of the merge inlined in trytond.report.Report.parse of 3.0
+        content_z = zipfile.ZipFile(StringIO.StringIO(content))
+        style_z = zipfile.ZipFile(StringIO.StringIO(style_content))
+        pictures = [f for f in style_z.namelist() if f.startswith('Pictures')]
+        style_tree = lxml.etree.parse(
+            StringIO.StringIO(content_z.read('styles.xml')))
+        new_style_tree = lxml.etree.parse(
+            StringIO.StringIO(style_z.read('styles.xml')))
+        for style in ('master-styles', 'automatic-styles'):
+            xpath = '/office:document-styles/office:%s' % style
+            node, = style_tree.xpath(xpath,
+                namespaces=style_tree.getroot().nsmap)
+            new_node, = new_style_tree.xpath(xpath,
+                namespaces=new_style_tree.getroot().nsmap)
+            node.getparent().replace(node, new_node)
+
+        output = StringIO.StringIO()
+        with closing(zipfile.ZipFile(output, mode='w')) as outzip:
+            for f in content_z.infolist():
+                data = content_z.read(f.filename)
+                if f.filename == 'styles.xml':
+                    data = lxml.etree.tostring(style_tree, encoding='utf-8',
+                        xml_declaration=True)
+                elif Manifest and f.filename == MANIFEST:
+                    manifest = Manifest(data)
+                    for picture in pictures:
+                        manifest.add_file_entry(picture)
+                    data = str(manifest)
+                outzip.writestr(f, data)
+            for picture in pictures:
+                outzip.writestr(picture, style_z.read(picture))
+        return output.getvalue()
+
+
+if __name__ == '__main__':
+    _render_main(sys.argv[1])
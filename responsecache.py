@@ -0,0 +1,197 @@
+import time
+from functools import wraps
+from threading import Event, Lock, local
+
+from trytond.cache import Cache
+from trytond.config import CONFIG
+from trytond.transaction import Transaction
+from nereid import current_app, current_user, request
+from nereid.globals import session
+from nereid.ctx import has_request_context
+from nereid.signals import transaction_start
+from nereid.templating import LazyRenderer
+
+__all__ = ['GenerationCache', 'ResponseCache', 'response_cache',
+    'cached_response']
+
+
+class _Flight(object):
+    "A response being computed, waited for by the identical requests"
+
+    def __init__(self):
+        self.event = Event()
+        self.value = None
+
+
+class GenerationCache(object):
+    """
+    Cache of values by key, for all the users, whose clear() drops all the
+    entries, of every process when the server runs with multi_server.
+
+    Each clear() increments the generation of the database, once when called
+    and again when its transaction commits, and a value is only stored when
+    the generation did not change since its transaction started, so that a
+    value read before the commit is not kept after it.
+    """
+
+    def __init__(self, name, size_limit=1024):
+        self._cache = Cache(name, context=False, size_limit=size_limit)
+        self._generations = {}
+        self._started = local()
+        self._lock = Lock()
+        transaction_start.connect(self.start, weak=False)
+
+    def start(self, sender=None):
+        "Remember the generation of the database of the new transaction"
+        dbname = Transaction().cursor.dbname
+        self._started.key = (dbname, self._generations.get(dbname, 0))
+
+    def generation(self):
+        "Return the generation of the database when the transaction started"
+        dbname = Transaction().cursor.dbname
+        started = getattr(self._started, 'key', None)
+        if started is not None and started[0] == dbname:
+            return started[1]
+        return self._generations.get(dbname, 0)
+
+    def clear(self):
+        "Drop all the entries now and once the transaction is committed"
+        cursor = Transaction().cursor
+        self._invalidate(cursor.dbname)
+        caches = getattr(cursor, '_generation_caches', None)
+        if caches is None:
+            caches = cursor._generation_caches = set()
+            commit = cursor.commit
+
+            def commit_and_clear():
+                commit()
+                for cache in caches:
+                    cache._invalidate(cursor.dbname)
+            cursor.commit = commit_and_clear
+        caches.add(self)
+
+    def _invalidate(self, dbname):
+        with self._lock:
+            self._generations[dbname] = self._generations.get(dbname, 0) + 1
+        self._cache.clear()
+
+    def get(self, key):
+        "Return the value of the key or None"
+        return self._cache.get(key)
+
+    def set(self, key, value, generation):
+        "Store the value of the key if computed at the current generation"
+        dbname = Transaction().cursor.dbname
+        if self._generations.get(dbname, 0) == generation:
+            self._cache.set(key, value)
+
+
+class ResponseCache(GenerationCache):
+    """
+    Cache of the responses of routes by database, host, path, query
+    arguments and language, for the anonymous users only.
+
+    Entries expire after songbook_response_cache_ttl seconds and at most
+    songbook_response_cache_size are kept, the least recently used being
+    dropped first. Concurrent identical requests missing the cache are
+    coalesced: the first one computes the response and the others wait for
+    it, at most songbook_response_cache_wait seconds.
+    """
+
+    def __init__(self, name):
+        super(ResponseCache, self).__init__(name,
+            size_limit=int(CONFIG.get('songbook_response_cache_size', 256)))
+        self._flights = {}
+
+    @staticmethod
+    def ttl():
+        return float(CONFIG.get('songbook_response_cache_ttl', 0) or 0)
+
+    @staticmethod
+    def wait():
+        return float(CONFIG.get('songbook_response_cache_wait', 10) or 0)
+
+    @staticmethod
+    def key():
+        "Return the key of the response of the current request or None"
+        if (request.method != 'GET'
+                or not current_user.is_anonymous()
+                or session.get('_flashes')):
+            return None
+        args = tuple(sorted((k, tuple(v))
+                for k, v in request.args.iterlists()))
+        return (request.host, request.path, args, Transaction().language)
+
+    def get(self, key):
+        "Return the (data, status, headers) of the key or None if expired"
+        entry = super(ResponseCache, self).get(key)
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+
+    def set(self, key, value, generation):
+        """
+        Store the (data, status, headers) of the key if successful and
+        computed at the current generation
+        """
+        if value[1] == 200:
+            super(ResponseCache, self).set(key,
+                (time.time() + self.ttl(), value), generation)
+
+    def fetch(self, key, compute):
+        """
+        Return the cached value of the key or the value returned by compute,
+        computing it once for the concurrent calls with the same key.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        generation = self.generation()
+        flight_key = (Transaction().cursor.dbname, generation, key)
+        with self._lock:
+            flight = self._flights.get(flight_key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[flight_key] = _Flight()
+        if not leader:
+            flight.event.wait(self.wait())
+            if flight.value is not None:
+                return flight.value
+            # The leader failed or is too slow, compute it again
+            return compute()
+        try:
+            flight.value = compute()
+            self.set(key, flight.value, generation)
+            return flight.value
+        finally:
+            with self._lock:
+                del self._flights[flight_key]
+            flight.event.set()
+
+
+# Cleared when any record of the module is created, modified or deleted
+response_cache = ResponseCache('songbook.response')
+
+
+def cached_response(func):
+    """
+    Answer the decorated route from the response cache when the
+    songbook_response_cache_ttl option is set.
+    """
+    @wraps(func)
+    def wrapper(cls_or_self, *args, **kwargs):
+        key = None
+        if ResponseCache.ttl() > 0 and has_request_context():
+            key = ResponseCache.key()
+        if key is None:
+            return func(cls_or_self, *args, **kwargs)
+
+        def compute():
+            result = func(cls_or_self, *args, **kwargs)
+            if isinstance(result, LazyRenderer):
+                result = (unicode(result), result.status, result.headers)
+            response = current_app.make_response(result)
+            return (response.get_data(), response.status_code,
+                list(response.headers))
+        data, status, headers = response_cache.fetch(key, compute)
+        return current_app.response_class(data, status, headers)
+    return wrapper
@@ -41,6 +41,8 @@ setup(name='trytond_songbook',
     package_dir={'trytond.modules.songbook': '.'},
     packages=[
         'trytond.modules.songbook',
+        'trytond.modules.songbook.benchmark',
+        'trytond.modules.songbook.tests',
         ],
     package_data={
         'trytond.modules.songbook': (info.get('xml', [])
@@ -63,6 +65,8 @@ setup(name='trytond_songbook',
     license='GPL-3',
     install_requires=requires,
     zip_safe=False,
+    test_suite='tests',
+    test_loader='trytond.test_loader:Loader',
     entry_points="""
     [trytond.modules]
     songbook = trytond.modules.songbook
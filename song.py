@@ -1,5 +1,14 @@
+import json
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from contextlib import contextmanager
+
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pool import Pool
+from trytond.transaction import Transaction
+from sql import Asc, Literal
+from sql.conditionals import Coalesce
+from sql.functions import Now
+from sql.operators import In, Exists
 from nereid import (
     request, abort, render_template, login_required, url_for, flash, jsonify,
     current_app, route
@@ -7,41 +16,141 @@ from nereid import (
 from nereid.contrib.pagination import Pagination, BasePagination
 from nereid.ctx import has_request_context
 
+from .index import PrefixIndex
+from .pagination import KeysetPagination
+from .prefetch import prefetch
+from .profiling import profiled
+from .responsecache import (GenerationCache, response_cache,
+    cached_response)
+from .tools import (update_column, url_template, sort_key, api_limit,
+    api_ids, api_fields, project, to_datetime)
+
 __all__ = ['Song']
 
+DUMP_BATCH_SIZE = 500
+
+
+@contextmanager
+def _read_transaction(database_name, user, context):
+    "Start a read-only transaction unless one is already started"
+    if Transaction().cursor is not None:
+        yield
+    else:
+        with Transaction().start(database_name, user, readonly=True,
+                context=context):
+            yield
+
 
 class Song(ModelSQL, ModelView):
     "Song"
     __name__ = "songbook.song"
 
     title = fields.Char('Title', 64, required=True, select=True)
-    artist = fields.Many2One("songbook.artist", 'Artist', required=True)
+    title_sort = fields.Char('Title Sort Key', readonly=True, select=True)
+    artist = fields.Many2One("songbook.artist", 'Artist', required=True,
+        select=True)
     tracks = fields.One2Many(
         "songbook.track",
         'song',
         'Tracks of This Song'
     )
+    _prefix_index = GenerationCache('songbook.song.prefix_index',
+        size_limit=1)
+    # The keys of the API payloads which can be selected with fields=
+    _api_fields = ['url', 'title', 'artist']
+    # The paths of the records shown by the detail page, read beforehand
+    _detail_prefetch = ['artist', 'tracks.album.songbook',
+        'tracks.album.publisher']
 
-    def get_rec_name(self, name):
-        return " | ".join(
-            x for x in [self.title, self.artist.full_name] if x
-        )
+    @classmethod
+    def get_rec_name(cls, songs, name):
+        result = {}
+        for id_, title, artist in cls._read_with_artist([s.id for s in songs]):
+            result[id_] = " | ".join(x for x in [title, artist] if x)
+        return result
 
     def serialize(self):
         """
         Serialize the song object and return a dictionary.
         """
-        object_json = {
-            "url": url_for(
-                'songbook.song.render_html',
-                id=self.id,
-            ),
-            "objectType": self.__name__,
-            "id": self.id,
-            "title": self.title,
-            "artist": self.artist.full_name,
+        return self.serialize_many([self])[0]
+
+    @classmethod
+    def serialize_many(cls, songs, fields=None):
+        """
+        Serialize the song objects and return a list of dictionaries
+        in the same order, skipping the songs that do not exist or that
+        the user may not read.
+        Besides objectType and id, only the keys of _api_fields in fields
+        (all when None) are read and returned.
+        """
+        pool = Pool()
+        Artist = pool.get('songbook.artist')
+        ModelAccess = pool.get('ir.model.access')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        artist = Artist.__table__()
+        if fields is None:
+            fields = cls._api_fields
+        columns = {
+            'title': table.title,
+            'artist': artist.full_name,
         }
-        return object_json
+        names = [f for f in fields if f in columns]
+        query = table
+        ModelAccess.check(cls.__name__, 'read')
+        if 'artist' in names:
+            ModelAccess.check(Artist.__name__, 'read')
+            query = table.join(artist, condition=(artist.id == table.artist))
+        ids = [s.id for s in songs]
+        values = {}
+        for i in range(0, len(ids), cursor.IN_MAX):
+            # Search to apply the record rules
+            sub_ids = [r.id for r in cls.search(
+                    [('id', 'in', ids[i:i + cursor.IN_MAX])], order=[])]
+            if not sub_ids:
+                continue
+            cursor.execute(*query.select(
+                    table.id, *[columns[n] for n in names],
+                    where=In(table.id, sub_ids)))
+            for row in cursor.fetchall():
+                values[row[0]] = dict(zip(names, row[1:]))
+        url = None
+        if 'url' in fields:
+            url = url_template('songbook.song.render_html')
+        result = []
+        for song in songs:
+            if song.id not in values:
+                continue
+            payload = {
+                "objectType": cls.__name__,
+                "id": song.id,
+            }
+            payload.update(values[song.id])
+            if url:
+                payload['url'] = url % song.id
+            result.append(payload)
+        return result
+
+    @classmethod
+    def _read_with_artist(cls, ids):
+        """
+        Generate (id, title, artist full name) for the song ids with one
+        query per batch of ids.
+        """
+        Artist = Pool().get('songbook.artist')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        artist = Artist.__table__()
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*table.join(
+                    artist, condition=(artist.id == table.artist)
+                    ).select(
+                    table.id, table.title, artist.full_name,
+                    where=In(table.id, sub_ids)))
+            for row in cursor.fetchall():
+                yield row
 
     @classmethod
     def __setup__(cls):
@@ -50,15 +159,120 @@ class Song(ModelSQL, ModelView):
             ('name_artist_uniq', 'UNIQUE(title, artist)',
              'This song by this artist already exists in the system.')
         ]
-        cls._order.insert(0, ('title', 'ASC'))
+        cls._order.insert(0, ('title_sort', 'ASC'))
+        cls._order.insert(1, ('title', 'ASC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(Song, cls).__register__(module_name)
+        cls.update_sort_keys()
+
+    @classmethod
+    def update_sort_keys(cls):
+        "Recompute the title sort keys, after a change of the sort options"
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        cursor.execute(*table.select(table.id, table.title, table.title_sort))
+        update_column(cursor, table, table.title_sort,
+            dict((id_, sort_key(title))
+                for id_, title, title_sort in cursor.fetchall()
+                if sort_key(title) != title_sort))
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [x.copy() for x in vlist]
+        for values in vlist:
+            values['title_sort'] = sort_key(values.get('title'))
+        songs = super(Song, cls).create(vlist)
+        cls._prefix_index.clear()
+        response_cache.clear()
+        return songs
+
+    @classmethod
+    def write(cls, songs, values):
+        Catalog = Pool().get('songbook.catalog')
+        if 'title' in values:
+            values = values.copy()
+            values['title_sort'] = sort_key(values['title'])
+        super(Song, cls).write(songs, values)
+        Catalog.refresh_for('song', [s.id for s in songs])
+        cls._prefix_index.clear()
+        response_cache.clear()
+
+    @classmethod
+    def delete(cls, songs):
+        super(Song, cls).delete(songs)
+        cls._prefix_index.clear()
+        response_cache.clear()
+
+    @classmethod
+    def get_prefix_index(cls):
+        """
+        Return the prefix index of song titles and artist names, building
+        it if needed.
+        Return None when the index is disabled or over its size limit.
+        """
+        if not PrefixIndex.enabled():
+            return None
+        index = cls._prefix_index.get('index')
+        if index is None:
+            generation = cls._prefix_index.generation()
+            Artist = Pool().get('songbook.artist')
+            cursor = Transaction().cursor
+            table = cls.__table__()
+            artist = Artist.__table__()
+            cursor.execute(*table.join(
+                    artist, condition=(artist.id == table.artist)
+                    ).select(
+                    table.id, table.title, artist.full_name,
+                    order_by=[
+                        Asc(table.title_sort), Asc(table.title),
+                        Asc(table.id)
+                    ]))
+            entries = (({
+                        "objectType": cls.__name__,
+                        "id": id_,
+                        "title": title,
+                        "artist": full_name,
+                        }, {'title': title, 'artist': full_name})
+                for id_, title, full_name in cursor.fetchall())
+            index = PrefixIndex.build(entries) or False
+            cls._prefix_index.set('index', index, generation)
+        return index or None
 
     @classmethod
     @route('/songbook/api/songs', methods=['GET', 'POST'])
+    @profiled
+    @cached_response
     def call_api_index(cls):
         """
         JSON-formatted REST API to support 3rd party integration, apps
         and web page javascript such as search-as-you-type.
+        ids= returns the songs with these comma-separated ids instead and
+        fields= restricts the keys of the songs.
         """
+        limit = api_limit(5)
+        fields = api_fields(cls._api_fields)
+        ids = api_ids()
+        if ids is not None:
+            return jsonify(
+                songs=cls.serialize_many(cls.browse(ids), fields)
+            )
+
+        index = cls.get_prefix_index()
+        if index is not None:
+            startswith = request.args.get('titlestartswith', '').lower()
+            payloads = index.search({
+                    'title': request.args.get('titlecontains', ''),
+                    'artist': request.args.get('artistcontains', ''),
+                    }, limit,
+                predicate=lambda p: p['title'].lower().startswith(startswith))
+            url = url_template('songbook.song.render_html')
+            return jsonify(
+                songs=[project(dict(p, url=url % p['id']), fields)
+                    for p in payloads]
+            )
+
         artist_filter = '%' + request.args.get('artistcontains', '') + '%'
         title_filter = request.args.get('titlestartswith', '') \
             + '%' + request.args.get('titlecontains', '') + '%'
@@ -66,18 +280,268 @@ class Song(ModelSQL, ModelView):
             ('title', 'ilike', title_filter),
             ('artist.full_name', 'ilike', artist_filter)
         ]
-        songs = cls.search(domain, limit=int(request.args.get('limit', '5')))
+        songs = cls.search(domain, limit=limit)
+        return jsonify(
+            songs=cls.serialize_many(songs, fields)
+        )
+
+    @classmethod
+    @route('/songbook/api/search', methods=['GET', 'POST'])
+    @profiled
+    def call_api_search(cls):
+        """
+        JSON-formatted REST API searching songs by the words of their title,
+        artist, album names and track codes, the most relevant first.
+        """
+        Catalog = Pool().get('songbook.catalog')
+        limit = api_limit(10)
+        fields = api_fields(cls._api_fields)
+        song_ids = Catalog.search_fulltext(
+            request.args.get('q', ''), limit,
+            songbook=request.args.get('songbook', None, int)
+        )
         return jsonify(
-            songs=[s.serialize() for s in songs]
+            songs=cls.serialize_many(cls.browse(song_ids), fields)
         )
 
+    @staticmethod
+    def _window(table, since, until):
+        """
+        Return the condition on the songbook and version columns of table
+        selecting, for each songbook of the catalog versions until by
+        songbook id, the versions after the one of since (if any) and up to
+        the one of until.
+        """
+        window = Literal(False)
+        for songbook_id, version in until.iteritems():
+            clause = ((table.songbook == songbook_id)
+                & (table.version <= version))
+            if songbook_id in since:
+                clause &= table.version > since[songbook_id]
+            window |= clause
+        return window
+
+    @staticmethod
+    def encode_since(date, versions):
+        """
+        Return the since= of a catalog dump reading the catalog versions by
+        songbook id at date.
+        """
+        return urlsafe_b64encode(json.dumps(
+                [date.isoformat(), sorted(versions.iteritems())]))
+
+    @staticmethod
+    def decode_since(value):
+        """
+        Return the date and the catalog versions by songbook id of a since=
+        value or raise ValueError if it is invalid.
+        """
+        try:
+            date, versions = json.loads(urlsafe_b64decode(str(value)))
+            date = to_datetime(date.replace('T', ' '))
+            versions = dict((int(i), int(v)) for i, v in versions)
+        except (TypeError, ValueError, AttributeError):
+            raise ValueError('Invalid since: %r' % value)
+        return date, versions
+
+    @classmethod
+    def catalog_versions(cls):
+        "Return the catalog version of each songbook by id"
+        Songbook = Pool().get('songbook.songbook')
+        cursor = Transaction().cursor
+        songbook = Songbook.__table__()
+        cursor.execute(*songbook.select(songbook.id,
+                Coalesce(songbook.catalog_version, 0)))
+        return dict(cursor.fetchall())
+
+    @classmethod
+    def dump(cls, after=None, since=None, until=None):
+        """
+        Generate the songs with their artist and tracks as API payloads
+        ordered by id, starting after the song id after. With since, the
+        catalog versions by songbook id of the previous dump, only the songs
+        with a catalog row written after it and up to the catalog versions
+        until are generated. The catalog rows of a track are written again
+        whenever the track, its album, song, artist, publisher or songbook
+        changes, so a song without tracks is only in the full dumps.
+        The songs are read by batches of DUMP_BATCH_SIZE seeking past the
+        last id so memory stays flat whatever the size of the catalog.
+        """
+        pool = Pool()
+        Artist = pool.get('songbook.artist')
+        Catalog = pool.get('songbook.catalog')
+        Songbook = pool.get('songbook.songbook')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        artist = Artist.__table__()
+        catalog = Catalog.__table__()
+        songbook = Songbook.__table__()
+
+        where = None
+        if since is not None:
+            where = In(table.id, catalog.select(catalog.song,
+                    where=cls._window(catalog, since, until)))
+        while True:
+            seek = table.id > (after or 0)
+            if where is not None:
+                seek &= where
+            cursor.execute(*table.join(
+                    artist, condition=(artist.id == table.artist)
+                    ).select(
+                    table.id, table.title, artist.id, artist.last_name,
+                    artist.first_name, artist.full_name,
+                    where=seek,
+                    order_by=[Asc(table.id)],
+                    limit=DUMP_BATCH_SIZE))
+            songs = cursor.fetchall()
+            if not songs:
+                break
+            tracks = dict((s[0], []) for s in songs)
+            cursor.execute(*catalog.join(
+                    songbook, condition=(songbook.id == catalog.songbook)
+                    ).select(
+                    catalog.song, catalog.id, catalog.code, catalog.album,
+                    catalog.album_code, catalog.album_name, songbook.id,
+                    songbook.name,
+                    where=In(catalog.song, list(tracks)),
+                    order_by=[Asc(catalog.songbook), Asc(catalog.code)]))
+            for row in cursor.fetchall():
+                tracks[row[0]].append({
+                        "id": row[1],
+                        "code": row[2],
+                        "album": {
+                            "id": row[3],
+                            "code": row[4],
+                            "name": row[5],
+                        },
+                        "songbook": {
+                            "id": row[6],
+                            "name": row[7],
+                        },
+                    })
+            for (id_, title, artist_id, last_name, first_name,
+                    full_name) in songs:
+                yield {
+                    "objectType": cls.__name__,
+                    "id": id_,
+                    "title": title,
+                    "artist": {
+                        "id": artist_id,
+                        "lastName": last_name,
+                        "firstName": first_name,
+                        "fullName": full_name,
+                    },
+                    "tracks": tracks[id_],
+                    "cursor": KeysetPagination.encode_cursor('after', [id_]),
+                }
+            after = songs[-1][0]
+            if len(songs) < DUMP_BATCH_SIZE:
+                break
+
+    @classmethod
+    def dump_deletions(cls, since, until):
+        """
+        Generate a tombstone payload for each track code removed from a
+        songbook after the catalog versions by songbook id since and up to
+        those of until, and not added back by then, ordered by songbook and
+        code.
+        """
+        pool = Pool()
+        Catalog = pool.get('songbook.catalog')
+        Deletion = pool.get('songbook.catalog.deletion')
+        cursor = Transaction().cursor
+        catalog = Catalog.__table__()
+        deletion = Deletion.__table__()
+
+        cursor.execute(*deletion.select(deletion.songbook, deletion.code,
+                where=cls._window(deletion, since, until)
+                & ~Exists(catalog.select(catalog.id,
+                        where=(catalog.songbook == deletion.songbook)
+                        & (catalog.code == deletion.code)
+                        & cls._window(catalog, {}, until))),
+                group_by=[deletion.songbook, deletion.code],
+                order_by=[Asc(deletion.songbook), Asc(deletion.code)]))
+        while True:
+            rows = cursor.fetchmany(DUMP_BATCH_SIZE)
+            if not rows:
+                break
+            for songbook_id, code in rows:
+                yield {
+                    "objectType": Deletion.__name__,
+                    "code": code,
+                    "songbook": {
+                        "id": songbook_id,
+                    },
+                }
+
+    @classmethod
+    @route('/songbook/api/catalog.ndjson', methods=['GET'])
+    @profiled
+    def call_api_catalog(cls):
+        """
+        Stream the songs with their artist and tracks as newline-delimited
+        JSON for the partners mirroring the catalog.
+        cursor= resumes after the song which had this cursor and since=, the
+        X-Songbook-Since header of the previous dump, only streams the songs
+        changed since then, after a tombstone for each track code removed
+        from a songbook since then (when not resuming). The X-Songbook-Since
+        header holds the catalog versions read before streaming, which bound
+        what is streamed.
+        """
+        Deletion = Pool().get('songbook.catalog.deletion')
+        cursor = Transaction().cursor
+        after = None
+        if 'cursor' in request.args:
+            _, values = KeysetPagination.decode_cursor(
+                request.args['cursor'], 1)
+            if (values is None or isinstance(values[0], bool)
+                    or not isinstance(values[0], (int, long))):
+                abort(400)
+            after, = values
+        since = None
+        if request.args.get('since'):
+            try:
+                since_date, since = cls.decode_since(request.args['since'])
+            except ValueError:
+                abort(400)
+        cursor.execute('SELECT %s' % Now())
+        # The dates of the records are stored without time zone
+        now = to_datetime(cursor.fetchone()[0]).replace(tzinfo=None)
+        # The older deletions may have been removed
+        if since is not None and since_date < now - Deletion.retention():
+            abort(410)
+        # The stream is read in another transaction which may see changes
+        # committed since, they are left to the next dump
+        until = cls.catalog_versions()
+
+        database_name = cursor.database_name
+        user = Transaction().user
+        context = Transaction().context.copy()
+
+        def generate():
+            with _read_transaction(database_name, user, context):
+                if since is not None and after is None:
+                    for payload in cls.dump_deletions(since, until):
+                        yield json.dumps(payload) + '\n'
+                for payload in cls.dump(after=after, since=since,
+                        until=until):
+                    yield json.dumps(payload) + '\n'
+        response = current_app.response_class(generate(),
+            mimetype='application/x-ndjson')
+        response.headers['X-Songbook-Since'] = cls.encode_since(now, until)
+        return response
+
     @classmethod
     @route('/songbook/songs/<int:id>', methods=['GET'])
+    @profiled
     def render_html(cls, id=0):
         """
         output details of a selected song to web client
         """
-        song=cls.browse([id])[0]
+        songs = cls.search([('id', '=', id)])
+        if not songs:
+            abort(404)
+        song, = prefetch(songs, cls._detail_prefetch)
         return render_template(
             'songbook_song-detail.jinja',
             song=song
@@ -85,6 +549,8 @@ class Song(ModelSQL, ModelView):
 
     @classmethod
     @route('/songbook/songs', methods=['GET', 'POST'])
+    @profiled
+    @cached_response
     def render_html_index(cls):
         """
         output song list to web client
@@ -97,9 +563,16 @@ class Song(ModelSQL, ModelView):
             ('title', 'ilike', title_filter),
             ('artist.full_name', 'ilike', artist_filter)
         ]
-        songs = Pagination(
-            cls, domain, page, 25
-        )
+        if 'cursor' in request.args:
+            songs = KeysetPagination(
+                cls, domain, ['title_sort', 'title'], 25,
+                cursor=request.args.get('cursor'),
+                count=request.args.get('count', 0, int)
+            )
+        else:
+            songs = Pagination(
+                cls, domain, page, 25
+            )
 
         return render_template(
             'songbook_song-list.jinja',
@@ -1,25 +1,54 @@
+import csv
+import datetime
+import json
+import re
+from codecs import BOM_UTF8
+from itertools import groupby
+from tempfile import SpooledTemporaryFile
+
+from trytond.config import CONFIG
 from trytond.model import ModelView, ModelSQL, fields
-from trytond.report import Report
 from trytond.transaction import Transaction
 from trytond.pool import Pool
+from trytond.pyson import Eval
 from trytond.wizard import Wizard, StateView, Button, StateTransition
-from sql import Table, As, Literal, Column, Desc, Asc, Expression, Flavor
-from sql.conditionals import Coalesce
-from sql.operators import Or, And, Concat, ILike, In, Operator
+from sql import Table, As, Literal, Column, Desc, Asc, Expression, Flavor, For
+from sql.conditionals import Case, Coalesce
+from sql.functions import Now
+from sql.operators import Or, And, Concat, ILike, In, Operator, Exists
 from nereid import (
     request, abort, render_template, login_required, url_for, flash, jsonify,
     current_app, route
 )
 from nereid.contrib.pagination import Pagination, BasePagination
 
+from .lookup import TrackIndex
+from .pagination import KeysetPagination
+from .prefetch import prefetch
+from .profiling import profiled
+from .rendering import Lookup, ParallelReport
+from .responsecache import response_cache, cached_response
+from .tools import api_ids
+
 __all__ = [
     'Songbook',
     'ExportTracks',
     'ExportTracksStart',
     'ExportTracksResult',
-    'SongbookByArtist'
+    'ExportTracksQueued',
+    'ImportTracks',
+    'ImportTracksStart',
+    'ImportTracksResult',
+    'SongbookByArtist',
+    'SongbookByTitle',
 ]
 
+EXPORT_BATCH_SIZE = 1000
+EXPORT_SPOOL_SIZE = 4 * 1024 * 1024
+IMPORT_BATCH_SIZE = 1000
+IMPORT_REJECTED_SHOWN = 1000
+_JUKEBOX_TITLE = re.compile(r'^(.*) \.([^.]*)\.$')
+
 
 class Songbook(ModelSQL, ModelView):
     "Songbook"
@@ -37,15 +66,28 @@ class Songbook(ModelSQL, ModelView):
             'songbook.song',
             None,
             'Songs by Title in This Songbook'
-        ), 'get_songs_title'
+        ), 'get_songs'
     )
     songs_artist = fields.Function(
         fields.One2Many(
             'songbook.song',
             None,
             'Songs by Artist in This Songbook'
-        ), 'get_songs_artist'
+        ), 'get_songs'
     )
+    export_watermark = fields.Timestamp('Last Delta Export', readonly=True)
+    # Incremented with each change of the catalog of the songbook
+    catalog_version = fields.Integer('Catalog Version', readonly=True)
+    # The catalog version reached by the last delivered delta export
+    export_version = fields.Integer('Exported Catalog Version', readonly=True)
+    # Statistics maintained by the catalog
+    album_count = fields.Integer('Albums', readonly=True)
+    track_count = fields.Integer('Tracks', readonly=True)
+    song_count = fields.Integer('Songs', readonly=True)
+    artist_count = fields.Integer('Artists', readonly=True)
+    stats_date = fields.Timestamp('Statistics Changed', readonly=True)
+    # The paths of the records shown by the detail page, read beforehand
+    _detail_prefetch = ['albums.publisher', 'albums.tracks.song.artist']
 
     @classmethod
     def __setup__(cls):
@@ -56,49 +98,178 @@ class Songbook(ModelSQL, ModelView):
         ]
         cls._order.insert(0, ('name', 'ASC'))
 
-    def get_songs_title(self, name):
-        songdict = {}
-        songlist = []
+    @staticmethod
+    def default_catalog_version():
+        return 0
+
+    @staticmethod
+    def default_album_count():
+        return 0
+
+    @staticmethod
+    def default_track_count():
+        return 0
+
+    @staticmethod
+    def default_song_count():
+        return 0
+
+    @staticmethod
+    def default_artist_count():
+        return 0
+
+    @classmethod
+    def create(cls, vlist):
+        songbooks = super(Songbook, cls).create(vlist)
+        response_cache.clear()
+        return songbooks
+
+    @classmethod
+    def write(cls, songbooks, values):
+        Catalog = Pool().get('songbook.catalog')
+        super(Songbook, cls).write(songbooks, values)
+        if 'name' in values:
+            # The reports and the catalog dumps show the name
+            ids = [s.id for s in songbooks]
+            Catalog.bump_versions(ids)
+            Catalog.refresh_for('songbook', ids)
+        response_cache.clear()
 
-        for album in self.albums:
-            for track in album.tracks:
-                if track.song.rec_name not in songdict:
-                    songdict[track.song.rec_name] = track.song.id
+    @classmethod
+    def delete(cls, songbooks):
+        pool = Pool()
+        ids = [s.id for s in songbooks]
+        super(Songbook, cls).delete(songbooks)
+        for name in ['songbook.songs_by_artist', 'songbook.songs_by_title']:
+            pool.get(name, type='report').delete_cached(cls.__name__, ids)
+        response_cache.clear()
 
-        for song in sorted(songdict):
-            songlist.append(songdict[song])
+    @classmethod
+    def get_fingerprints(cls, ids):
+        """
+        Return a fingerprint of the content of the songbooks by id: their
+        catalog version, incremented under a lock of the songbook row by
+        every change of their name or catalog, so it follows the commit
+        order of the changes.
+        """
+        cursor = Transaction().cursor
+        songbook = cls.__table__()
+        fingerprints = {}
+        for i in range(0, len(ids), cursor.IN_MAX):
+            sub_ids = ids[i:i + cursor.IN_MAX]
+            cursor.execute(*songbook.select(songbook.id,
+                    songbook.catalog_version,
+                    where=In(songbook.id, sub_ids)))
+            for id_, version in cursor.fetchall():
+                fingerprints[id_] = str(version or 0)
+        return fingerprints
 
-        return songlist
+    @classmethod
+    def get_songs(cls, songbooks, names):
+        """
+        Return the distinct songs of each songbook, ordered by title or by
+        artist depending on the field.
+        """
+        orders = {
+            'songs_title': 'title',
+            'songs_artist': 'artist',
+        }
+        ids = [s.id for s in songbooks]
+        result = {}
+        for name in names:
+            result[name] = dict((i, []) for i in ids)
+            for row in cls.get_song_rows(ids, orders[name]):
+                result[name][row[0]].append(row[1])
+        return result
 
-    def get_songs_artist(self, name):
-        artdict = {}
-        artlist = []
+    @classmethod
+    def get_song_rows(cls, songbook_ids, order='title'):
+        """
+        Generate the distinct songs of the songbooks as tuples of
+        (songbook id, song id, title, artist last name, artist first name)
+        ordered by songbook then by title or by artist.
+        Rows are read from the catalog with one query per batch of
+        songbooks.
+        """
+        Catalog = Pool().get('songbook.catalog')
 
-        for album in self.albums:
-            for track in album.tracks:
-                songkey = track.song.artist.rev_name + ' | ' + track.song.title
-                if songkey not in artdict:
-                    artdict[songkey] = track.song.id
+        cursor = Transaction().cursor
 
-        for artist in sorted(artdict):
-            artlist.append(artdict[artist])
+        catalog = Catalog.__table__()
+
+        orders = {
+            'title': [
+                catalog.title_sort, catalog.title, catalog.artist_sort_name,
+                catalog.song
+            ],
+            'artist': [
+                catalog.artist_sort_name, catalog.artist_last_name,
+                catalog.artist_first_name, catalog.title_sort, catalog.title,
+                catalog.song
+            ],
+        }
 
-        return artlist
+        for i in range(0, len(songbook_ids), cursor.IN_MAX):
+            sub_ids = songbook_ids[i:i + cursor.IN_MAX]
+            query = catalog.select(
+                catalog.songbook, catalog.song, catalog.title,
+                catalog.artist_last_name, catalog.artist_first_name,
+                where=In(catalog.songbook, sub_ids),
+                group_by=[
+                    catalog.songbook, catalog.song, catalog.title,
+                    catalog.artist_last_name, catalog.artist_first_name,
+                    catalog.title_sort, catalog.artist_sort_name
+                ],
+                order_by=[Asc(catalog.songbook)]
+                + [Asc(c) for c in orders[order]]
+            )
+            cursor.execute(*query)
+            while True:
+                rows = cursor.fetchmany(cursor.IN_MAX)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
 
     @classmethod
     @route('/songbook/songbooks/<int:id>')
+    @profiled
     def render_html(cls, id=1):
         """
         output songbook home page to client
         """
-        songbook=cls.browse([id])[0]
+        songbooks = cls.search([('id', '=', id)])
+        if not songbooks:
+            abort(404)
+        songbook, = prefetch(songbooks, cls._detail_prefetch)
         return render_template(
             'songbook_songbook-detail.jinja',
             songbook=songbook
         )
 
+    @classmethod
+    @route('/songbook/api/stats', methods=['GET'])
+    @profiled
+    def call_api_stats(cls):
+        """
+        JSON-formatted statistics of the songbooks and publishers, and of
+        the artists with the comma-separated ids of artists=.
+        """
+        Catalog = Pool().get('songbook.catalog')
+        result = {
+            'songbooks': Catalog.serialize_statistics('songbook'),
+            'publishers': Catalog.serialize_statistics('publisher'),
+        }
+        artist_ids = api_ids('artists')
+        if artist_ids is not None:
+            result['artists'] = Catalog.serialize_statistics('artist',
+                artist_ids)
+        return jsonify(**result)
+
     @classmethod
     @route('/songbook/songbooks', methods=['GET', 'POST'])
+    @profiled
+    @cached_response
     def render_html_index(cls):
         """
         output song list to web client
@@ -108,9 +279,16 @@ class Songbook(ModelSQL, ModelView):
         domain = [
             ('name', 'ilike', name_filter)
         ]
-        songbooks = Pagination(
-            cls, domain, page, 25
-        )
+        if 'cursor' in request.args:
+            songbooks = KeysetPagination(
+                cls, domain, ['name'], 25,
+                cursor=request.args.get('cursor'),
+                count=request.args.get('count', 0, int)
+            )
+        else:
+            songbooks = Pagination(
+                cls, domain, page, 25
+            )
 
         return render_template(
             'songbook_songbook-list.jinja',
@@ -119,6 +297,7 @@ class Songbook(ModelSQL, ModelView):
 
     @classmethod
     @route('/songbook')
+    @profiled
     def render_html_home(cls):
         """
         output the home page of the songbook web app to client
@@ -141,111 +320,695 @@ class ExportTracks(Wizard):
     result = StateView(
         'songbook.songbook.export_tracks.result',
         'songbook.songbook_export_tracks_result_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Done', 'done', 'tryton-ok', default=True),
+        ]
+    )
+    done = StateTransition()
+    queued = StateView(
+        'songbook.songbook.export_tracks.queued',
+        'songbook.songbook_export_tracks_queued_view_form', [
             Button('Close', 'end', 'tryton-cancel'),
         ]
     )
 
+    @profiled
     def transition_export(self):
         """
         Delimited text file for import into CAVS or similar jukebox
         """
-        pool = Pool()
-        Song = pool.get('songbook.song')
-        Artist = pool.get('songbook.artist')
-        Publisher = pool.get('songbook.publisher')
-        Album = pool.get('songbook.album')
-        Track = pool.get('songbook.track')
-
-        cursor = Transaction().cursor
-
-        song = Song.__table__()
-        artist = Artist.__table__()
-        publisher = Publisher.__table__()
-        album = Album.__table__()
-        track = Track.__table__()
+        ExportJob = Pool().get('songbook.export.job')
 
         songbook_ids = Transaction().context.get('active_ids')
+        if self.start.background:
+            user = Transaction().user
+            # Only the songbook administrators may write the jobs
+            with Transaction().set_user(0):
+                self.queued.job, = ExportJob.create([{
+                            'user': user,
+                            'songbooks': [('add', songbook_ids)],
+                            'mode': self.start.mode,
+                            'index': self.start.index,
+                            }])
+            return 'queued'
+
+        self.result.watermarks = None
+        with SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as file_:
+            if self.start.mode == 'delta':
+                watermarks = self.delta_watermarks(songbook_ids)
+                self.write_delta(file_, watermarks)
+                # Moved only once the file is delivered
+                self.result.watermarks = json.dumps(
+                    sorted(watermarks.iteritems()))
+            else:
+                self.write_tracks(file_, songbook_ids)
+            file_.seek(0)
+            self.result.file = buffer(file_.read())
+        self.result.index = None
+        if self.start.mode == 'full' and self.start.index:
+            with SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as file_:
+                self.write_index(file_, songbook_ids)
+                file_.seek(0)
+                self.result.index = buffer(file_.read())
+        return 'result'
 
-        title_and_publisher = Concat(
-            song.title, Concat(
-                Literal(' .'), Concat(publisher.code, Literal('.'))
-            )
-        )
+    @classmethod
+    def write_tracks(cls, file_, songbook_ids, progress=None):
+        """
+        Write the tracks of the songbooks to file_ as UTF-8 encoded,
+        pipe-delimited lines separated by CRLF.
+        The cursor is read in fixed-size batches so memory stays flat
+        whatever the number of tracks. progress is called with the number
+        of lines written after each batch. Return the number of lines
+        written.
+        """
+        Catalog = Pool().get('songbook.catalog')
 
-        artist_fullname = Concat(
-            Coalesce(artist.first_name, Literal('')),
-            Concat(
-                Literal(' '),
-                Coalesce(artist.last_name, Literal(''))
-            )
-        )
+        cursor = Transaction().cursor
 
-        export_select = track.join(
-            album, condition=(album.id == track.album)
-        ).join(
-            publisher, condition=(publisher.id == album.publisher)
-        ).join(
-            song, condition=(song.id == track.song)
-        ).join(
-            artist, condition=(artist.id == song.artist)
-        ).select(
-            track.code, title_and_publisher, artist_fullname,
-            where=In(album.songbook, songbook_ids)
+        catalog = Catalog.__table__()
+
+        export_select = catalog.select(
+            catalog.line,
+            where=In(catalog.songbook, songbook_ids)
         )
-        export_select.order_by = Asc(track.code)
+        export_select.order_by = Asc(catalog.code)
 
         cursor.execute(*export_select)
 
-        rv_list = ['|'.join(x) for x in cursor.fetchall()]
+        count = 0
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            lines = u'\r\n'.join(x[0] for x in rows)
+            if count:
+                lines = u'\r\n' + lines
+            file_.write(lines.encode('utf-8'))
+            count += len(rows)
+            if progress:
+                progress(count)
+        return count
 
-        self.result.file = buffer(bytearray(u'\r\n'.join(rv_list), 'utf-8'))
-        return 'result'
+    @classmethod
+    def write_index(cls, file_, songbook_ids):
+        """
+        Write the track code index (see TrackIndex) of the tracks of the
+        songbooks to file_ and return the number of tracks.
+        """
+        Catalog = Pool().get('songbook.catalog')
+
+        cursor = Transaction().cursor
+
+        catalog = Catalog.__table__()
+
+        cursor.execute(*catalog.select(
+                catalog.code, catalog.title, catalog.artist_full_name,
+                where=In(catalog.songbook, songbook_ids),
+                order_by=[catalog.code, catalog.songbook]))
+
+        def rows():
+            while True:
+                rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        return TrackIndex.write(file_, rows())
+
+    @classmethod
+    def delta_watermarks(cls, songbook_ids):
+        """
+        Return by songbook id the catalog version reached by a delta export
+        of the songbooks now. The songbook rows are locked until the end of
+        the transaction.
+        """
+        Songbook = Pool().get('songbook.songbook')
+
+        cursor = Transaction().cursor
+
+        songbook = Songbook.__table__()
+
+        for_ = None
+        if CONFIG['db_type'] == 'postgresql':
+            for_ = For('UPDATE')
+        songbook_ids = sorted(set(songbook_ids))
+        watermarks = {}
+        for i in range(0, len(songbook_ids), cursor.IN_MAX):
+            sub_ids = songbook_ids[i:i + cursor.IN_MAX]
+            cursor.execute(*songbook.select(songbook.id,
+                    Coalesce(songbook.catalog_version, 0),
+                    where=In(songbook.id, sub_ids),
+                    order_by=[songbook.id.asc], for_=for_))
+            watermarks.update(cursor.fetchall())
+        return watermarks
+
+    @classmethod
+    def write_delta(cls, file_, watermarks, progress=None):
+        """
+        Write the changes of the tracks of the songbooks since their last
+        delivered delta export up to the watermarks by songbook id returned
+        by delta_watermarks to file_, like write_tracks but with an
+        operation column first: A for an added track, U for a changed one
+        and D for a removed code (with empty title and artist). Tracks count
+        as added when the songbook was never exported in delta.
+        Return the number of lines written. progress is called like in
+        write_tracks. confirm_delta must be called with the watermarks once
+        the file is delivered.
+        """
+        pool = Pool()
+        Songbook = pool.get('songbook.songbook')
+        Catalog = pool.get('songbook.catalog')
+        Deletion = pool.get('songbook.catalog.deletion')
+
+        cursor = Transaction().cursor
+
+        songbook = Songbook.__table__()
+        catalog = Catalog.__table__()
+        deletion = Deletion.__table__()
+
+        count = 0
+        for songbook_id, version in sorted(watermarks.iteritems()):
+            # Read from the table as confirm_delta bypasses the record cache
+            cursor.execute(*songbook.select(songbook.export_version,
+                    where=songbook.id == songbook_id))
+            since, = cursor.fetchone()
+
+            queries = []
+            if since is not None:
+                queries.append(deletion.select(
+                        Literal('D'), Concat(deletion.code, Literal('||')),
+                        where=(deletion.songbook == songbook_id)
+                        & (deletion.version > since)
+                        & (deletion.version <= version)
+                        & ~Exists(catalog.select(catalog.id,
+                                where=(catalog.songbook == deletion.songbook)
+                                & (catalog.code == deletion.code)
+                                & (catalog.version <= version))),
+                        group_by=[deletion.code],
+                        order_by=[deletion.code]))
+                operation = Case(
+                    (catalog.added_version > since, Literal('A')),
+                    else_=Literal('U'))
+                where = catalog.version > since
+            else:
+                operation = Literal('A')
+                where = Literal(True)
+            queries.append(catalog.select(operation, catalog.line,
+                    where=where & (catalog.songbook == songbook_id)
+                    & (catalog.version <= version),
+                    order_by=[catalog.code]))
+
+            for query in queries:
+                cursor.execute(*query)
+                while True:
+                    rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                    if not rows:
+                        break
+                    lines = u'\r\n'.join(u'%s|%s' % x for x in rows)
+                    if count:
+                        lines = u'\r\n' + lines
+                    file_.write(lines.encode('utf-8'))
+                    count += len(rows)
+                    if progress:
+                        progress(count)
+        return count
+
+    @classmethod
+    def confirm_delta(cls, watermarks):
+        """
+        Move the watermarks of the songbooks once their delta export is
+        delivered, unless a later one was, and remove the deletions logged
+        up to the watermark of their songbook and older than the retention
+        of the catalog dumps
+        """
+        pool = Pool()
+        Songbook = pool.get('songbook.songbook')
+        Deletion = pool.get('songbook.catalog.deletion')
+
+        cursor = Transaction().cursor
+
+        songbook = Songbook.__table__()
+        deletion = Deletion.__table__()
+
+        expired = datetime.datetime.now() - Deletion.retention()
+        for id_, version in sorted(watermarks.iteritems()):
+            cursor.execute(*songbook.update(
+                    [songbook.export_version, songbook.export_watermark],
+                    [version, Now()],
+                    where=(songbook.id == id_)
+                    & ((songbook.export_version == None)
+                        | (songbook.export_version < version))))
+            cursor.execute(*deletion.delete(
+                    where=(deletion.songbook == id_)
+                    & (deletion.create_date < expired)
+                    & (deletion.version <= songbook.select(
+                            songbook.export_version,
+                            where=songbook.id == id_))))
+
+    def transition_done(self):
+        if self.result.watermarks:
+            self.confirm_delta(dict(json.loads(self.result.watermarks)))
+        return 'end'
 
     def default_result(self, fields):
-        file_ = self.result.file
-        self.result.file = False  # No need to store it in session
+        file_, index = self.result.file, self.result.index
+        # No need to store them in session
+        self.result.file = self.result.index = False
         return {
             'file': file_,
+            'index': index,
+        }
+
+    def default_queued(self, fields):
+        return {
+            'job': self.queued.job.id,
         }
 
 class ExportTracksStart(ModelView):
     "Export Tracks in Songbook"
     __name__ = 'songbook.songbook.export_tracks.start'
 
+    mode = fields.Selection([
+            ('full', 'All Tracks'),
+            ('delta', 'Changes Since Last Delta Export'),
+            ], 'Mode', required=True)
+    background = fields.Boolean('Run in Background',
+        help='Export in a separate job whose file is attached to the '
+        'songbooks, for large exports.')
+    index = fields.Boolean('Track Code Index',
+        states={
+            'invisible': Eval('mode') != 'full',
+            }, depends=['mode'],
+        help='Also export a binary index of the titles and artists by track '
+        'code, for the jukebox lookups.')
+
+    @staticmethod
+    def default_mode():
+        return 'full'
+
+    @staticmethod
+    def default_background():
+        return False
+
+    @staticmethod
+    def default_index():
+        return False
+
 class ExportTracksResult(ModelView):
     "Export Tracks in Songbook"
     __name__ = 'songbook.songbook.export_tracks.result'
 
     file = fields.Binary('File', readonly=True)
+    index = fields.Binary('Track Code Index', readonly=True)
+    # The delta export watermarks to confirm once the file is saved
+    watermarks = fields.Text('Watermarks', readonly=True)
+
+class ExportTracksQueued(ModelView):
+    "Export Tracks in Songbook"
+    __name__ = 'songbook.songbook.export_tracks.queued'
+
+    job = fields.Many2One('songbook.export.job', 'Job', readonly=True)
+
+class ImportTracks(Wizard):
+    "Import Tracks in Songbook"
+    __name__ = 'songbook.songbook.import_tracks'
+
+    start = StateView(
+        'songbook.songbook.import_tracks.start',
+        'songbook.songbook_import_tracks_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+        ]
+    )
+    import_ = StateTransition()
+    result = StateView(
+        'songbook.songbook.import_tracks.result',
+        'songbook.songbook_import_tracks_result_view_form', [
+            Button('Close', 'end', 'tryton-cancel'),
+        ]
+    )
+
+    def default_start(self, fields):
+        context = Transaction().context
+        if context.get('active_model') == 'songbook.songbook':
+            return {
+                'songbook': context.get('active_id'),
+            }
+        return {}
+
+    @profiled
+    def transition_import_(self):
+        """
+        Load a jukebox or CSV file into the songbook, creating the missing
+        publishers, artists, songs, albums and tracks batch by batch
+        """
+        data = str(self.start.file)
+        if self.start.format == 'csv':
+            lines = self.read_csv(data, self.start.album_separator)
+        else:
+            lines = self.read_jukebox(data, self.start.album_separator,
+                self.start.name_split)
+
+        created, matched, rejected = 0, 0, []
+        batch = []
+        for line, values in lines:
+            error = self.check_values(values)
+            if error:
+                rejected.append((line, error))
+                continue
+            batch.append((line, values))
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                result = self.import_rows(self.start.songbook, batch)
+                created += result[0]
+                matched += result[1]
+                rejected.extend(result[2])
+                batch = []
+        if batch:
+            result = self.import_rows(self.start.songbook, batch)
+            created += result[0]
+            matched += result[1]
+            rejected.extend(result[2])
+
+        self.result.created = created
+        self.result.matched = matched
+        self.result.rejected = len(rejected)
+        self.result.rejected_lines = u'\n'.join(
+            u'%s: %s' % (error, line)
+            for line, error in rejected[:IMPORT_REJECTED_SHOWN])
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'created': self.result.created,
+            'matched': self.result.matched,
+            'rejected': self.result.rejected,
+            'rejected_lines': self.result.rejected_lines,
+        }
+
+    @staticmethod
+    def album_code(code, separator):
+        "Return the album code of a track code"
+        if separator and separator in code:
+            return code.rsplit(separator, 1)[0]
+        return code
+
+    @staticmethod
+    def split_name(name, name_split='last'):
+        """
+        Return the last and first names of an artist full name: the last
+        word is the last name with name_split 'last' and the first word is
+        the first name with 'first'.
+        """
+        words = name.split()
+        if len(words) < 2:
+            return name.strip(), None
+        if name_split == 'first':
+            return u' '.join(words[1:]), words[0]
+        return words[-1], u' '.join(words[:-1])
+
+    @classmethod
+    def read_jukebox(cls, data, separator, name_split='last'):
+        """
+        Generate (line, values) for the lines of a file in the format of
+        ExportTracks. values is None when the line can not be parsed.
+        The artist full name is split following name_split.
+        """
+        if data.startswith(BOM_UTF8):
+            data = data[len(BOM_UTF8):]
+        for line in data.decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            parts = line.split('|')
+            match = len(parts) == 3 and _JUKEBOX_TITLE.match(parts[1])
+            if not match:
+                yield line, None
+                continue
+            last_name, first_name = cls.split_name(parts[2], name_split)
+            yield line, {
+                'code': parts[0],
+                'album_code': cls.album_code(parts[0], separator),
+                'album_name': None,
+                'title': match.group(1),
+                'publisher_code': match.group(2),
+                'last_name': last_name,
+                'first_name': first_name,
+            }
+
+    @classmethod
+    def read_csv(cls, data, separator):
+        """
+        Generate (line, values) for the rows of a CSV file with a header
+        naming the columns code, title, publisher, artist_last_name and
+        optionally artist_first_name, album and album_name.
+        """
+        if data.startswith(BOM_UTF8):
+            data = data[len(BOM_UTF8):]
+        reader = csv.reader(data.splitlines())
+        header = [h.strip().lower() for h in next(reader, [])]
+        for row in reader:
+            row = [v.decode('utf-8').strip() for v in row]
+            line = u','.join(row)
+            if not any(row):
+                continue
+            if len(row) != len(header):
+                yield line, None
+                continue
+            row = dict(zip(header, row))
+            code = row.get('code')
+            yield line, {
+                'code': code,
+                'album_code': (row.get('album')
+                    or cls.album_code(code or '', separator)),
+                'album_name': row.get('album_name') or None,
+                'title': row.get('title'),
+                'publisher_code': row.get('publisher'),
+                'last_name': row.get('artist_last_name'),
+                'first_name': row.get('artist_first_name') or None,
+            }
+
+    @classmethod
+    def check_values(cls, values):
+        "Return the reason why the values can not be imported or None"
+        pool = Pool()
+        Publisher = pool.get('songbook.publisher')
+        Album = pool.get('songbook.album')
+        Song = pool.get('songbook.song')
+        Track = pool.get('songbook.track')
+
+        if values is None:
+            return 'Invalid line'
+        for key in ('code', 'album_code', 'title', 'publisher_code',
+                'last_name'):
+            if not values[key]:
+                return 'Missing %s' % key
+        for key, field in (
+                ('code', Track.code),
+                ('album_code', Album.code),
+                ('album_name', Album.name),
+                ('title', Song.title),
+                ('publisher_code', Publisher.code),
+                ):
+            if values[key] and len(values[key]) > field.size:
+                return 'Too long %s' % key
+
+    @staticmethod
+    def _search_in(Model, name, values, domain=None):
+        "Search the records whose field name is in values"
+        cursor = Transaction().cursor
+        values = list(values)
+        records = []
+        for i in range(0, len(values), cursor.IN_MAX):
+            sub_values = values[i:i + cursor.IN_MAX]
+            records.extend(Model.search(
+                    (domain or []) + [(name, 'in', sub_values)]))
+        return records
+
+    @classmethod
+    def import_rows(cls, songbook, rows):
+        """
+        Import the rows of values into the songbook with a fixed number of
+        searches and creations per model.
+        Return the number of created and matched tracks and the rejected
+        lines with their reason.
+        """
+        pool = Pool()
+        Publisher = pool.get('songbook.publisher')
+        Artist = pool.get('songbook.artist')
+        Song = pool.get('songbook.song')
+        Album = pool.get('songbook.album')
+        Track = pool.get('songbook.track')
 
-class SongbookByArtist(Report):
+        rows = [(values, line) for line, values in rows]
+
+        publishers = dict((p.code, p.id) for p in cls._search_in(
+                Publisher, 'code', set(r['publisher_code'] for r, _ in rows)))
+        missing = sorted(set(r['publisher_code'] for r, _ in rows)
+            - set(publishers))
+        if missing:
+            publishers.update((p.code, p.id) for p in Publisher.create(
+                    [{'code': c, 'name': c} for c in missing]))
+
+        names = set((r['last_name'], r['first_name']) for r, _ in rows)
+        artists = dict(((a.last_name, a.first_name), a.id)
+            for a in cls._search_in(
+                Artist, 'last_name', set(n[0] for n in names)))
+        missing = sorted(names - set(artists))
+        if missing:
+            artists.update(((a.last_name, a.first_name), a.id)
+                for a in Artist.create([{
+                            'last_name': l,
+                            'first_name': f,
+                            } for l, f in missing]))
+        for values, _ in rows:
+            values['artist'] = artists[
+                (values['last_name'], values['first_name'])]
+
+        keys = set((r['title'], r['artist']) for r, _ in rows)
+        songs = dict(((s.title, s.artist.id), s.id) for s in cls._search_in(
+                Song, 'title', set(k[0] for k in keys)))
+        missing = sorted(keys - set(songs))
+        if missing:
+            songs.update(((s.title, s.artist.id), s.id)
+                for s in Song.create([{
+                            'title': t,
+                            'artist': a,
+                            } for t, a in missing]))
+
+        albums = dict((a.code, a.id) for a in cls._search_in(
+                Album, 'code', set(r['album_code'] for r, _ in rows),
+                [('songbook', '=', songbook.id)]))
+        to_create = {}
+        for values, _ in rows:
+            if (values['album_code'] not in albums
+                    and values['album_code'] not in to_create):
+                to_create[values['album_code']] = {
+                    'songbook': songbook.id,
+                    'code': values['album_code'],
+                    'name': values['album_name'] or values['album_code'],
+                    'publisher': publishers[values['publisher_code']],
+                }
+        if to_create:
+            albums.update((a.code, a.id) for a in Album.create(
+                    [to_create[c] for c in sorted(to_create)]))
+
+        tracks = dict(((t.album.id, t.code), t.song.id)
+            for t in cls._search_in(Track, 'album', set(albums.values())))
+        created, matched, rejected = 0, 0, []
+        to_create = []
+        for values, line in rows:
+            key = (albums[values['album_code']], values['code'])
+            song_id = songs[(values['title'], values['artist'])]
+            if key not in tracks:
+                tracks[key] = song_id
+                to_create.append({
+                    'album': key[0],
+                    'code': key[1],
+                    'song': song_id,
+                })
+                created += 1
+            elif tracks[key] == song_id:
+                matched += 1
+            else:
+                rejected.append((line, 'Track code used by another song'))
+        if to_create:
+            Track.create(to_create)
+        return created, matched, rejected
+
+
+class ImportTracksStart(ModelView):
+    "Import Tracks in Songbook"
+    __name__ = 'songbook.songbook.import_tracks.start'
+
+    songbook = fields.Many2One('songbook.songbook', 'Songbook',
+        required=True)
+    format = fields.Selection([
+            ('jukebox', 'Jukebox'),
+            ('csv', 'CSV'),
+            ], 'Format', required=True)
+    album_separator = fields.Char('Album Separator',
+        help='The album code is the part of the track code before the last '
+        'separator when the file does not give it.')
+    name_split = fields.Selection([
+            ('last', 'Last Word Is the Last Name'),
+            ('first', 'First Word Is the First Name'),
+            ], 'Artist Name Split', required=True,
+        states={
+            'invisible': Eval('format') != 'jukebox',
+            }, depends=['format'],
+        help='How the artist full names of a jukebox file are split into '
+        'last and first names.')
+    file = fields.Binary('File', required=True)
+
+    @staticmethod
+    def default_format():
+        return 'jukebox'
+
+    @staticmethod
+    def default_name_split():
+        return 'last'
+
+    @staticmethod
+    def default_album_separator():
+        return '-'
+
+
+class ImportTracksResult(ModelView):
+    "Import Tracks in Songbook"
+    __name__ = 'songbook.songbook.import_tracks.result'
+
+    created = fields.Integer('Created', readonly=True)
+    matched = fields.Integer('Matched', readonly=True)
+    rejected = fields.Integer('Rejected', readonly=True)
+    rejected_lines = fields.Text('Rejected Lines', readonly=True)
+
+class SongbookByArtist(ParallelReport):
     __name__ = 'songbook.songs_by_artist'
+    record_fields = ['name']
 
     @classmethod
+    @profiled
     def parse(cls, report, objects, data, localcontext):
-        artlist = dict((s.id, []) for s in objects)
-        for songbook in objects:
-            artdict = {}
-            for album in songbook.albums:
-                for track in album.tracks:
-                    if track.song.artist.rev_name not in artdict:
-                        artdict[track.song.artist.rev_name] = {}
-                    if track.song.title not in artdict[
-                        track.song.artist.rev_name
-                    ]:
-                        artdict[track.song.artist.rev_name][
-                            track.song.title
-                        ] = track.song.id
-
-            for artkey in sorted(artdict):
-                artlist[songbook.id].append({
-                    'rev_name': artkey,
-                    'songs': sorted(artdict[artkey]),
-                })
+        pool = Pool()
+        Songbook = pool.get('songbook.songbook')
+        Artist = pool.get('songbook.artist')
+
+        artlist = Lookup((s.id, []) for s in objects)
+        rows = Songbook.get_song_rows(artlist.keys(), order='artist')
+        for (songbook_id, last_name, first_name), songs in groupby(
+                rows, key=lambda r: (r[0], r[3], r[4])):
+            artlist[songbook_id].append({
+                'rev_name': Artist.format_rev_name(last_name, first_name),
+                'songs': [s[2] for s in songs],
+            })
 
-        localcontext['artists'] = lambda songbook_id: artlist[songbook_id]
+        localcontext['artists'] = artlist
         res = super(SongbookByArtist, cls).parse(
             report, objects, data, localcontext
         )
         return res
 
+class SongbookByTitle(ParallelReport):
+    __name__ = 'songbook.songs_by_title'
+    record_fields = ['name']
+
+    @classmethod
+    @profiled
+    def parse(cls, report, objects, data, localcontext):
+        pool = Pool()
+        Songbook = pool.get('songbook.songbook')
+        Artist = pool.get('songbook.artist')
+
+        songlist = Lookup((s.id, []) for s in objects)
+        rows = Songbook.get_song_rows(songlist.keys(), order='title')
+        for songbook_id, _, title, last_name, first_name in rows:
+            songlist[songbook_id].append({
+                'title': title,
+                'artist': Artist.format_full_name(last_name, first_name),
+            })
+
+        localcontext['songs'] = songlist
+        res = super(SongbookByTitle, cls).parse(
+            report, objects, data, localcontext
+        )
+        return res
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+import sys
+import os
+DIR = os.path.abspath(os.path.normpath(os.path.join(__file__,
+    '..', '..', '..', '..', '..', 'trytond')))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+import unittest
+from StringIO import StringIO
+from tempfile import NamedTemporaryFile
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT, test_view,\
+    test_depends
+from trytond.transaction import Transaction
+
+from trytond.modules.songbook import lookup
+from trytond.modules.songbook.benchmark.explain import check
+from trytond.modules.songbook.benchmark.generator import DEFAULTS
+from trytond.modules.songbook.benchmark.run import catalog
+from trytond.modules.songbook.lookup import TrackIndex
+
+
+class SongbookTestCase(unittest.TestCase):
+    '''
+    Test Songbook module.
+    '''
+
+    def setUp(self):
+        trytond.tests.test_tryton.install_module('songbook')
+        self.songbook = POOL.get('songbook.songbook')
+        self.publisher = POOL.get('songbook.publisher')
+        self.album = POOL.get('songbook.album')
+        self.artist = POOL.get('songbook.artist')
+        self.song = POOL.get('songbook.song')
+        self.track = POOL.get('songbook.track')
+        self.catalog = POOL.get('songbook.catalog')
+        self.export_tracks = POOL.get('songbook.songbook.export_tracks',
+            type='wizard')
+        self.import_tracks = POOL.get('songbook.songbook.import_tracks',
+            type='wizard')
+
+    def create_songbooks(self):
+        '''
+        Create two songbooks sharing an album code and return them.
+        '''
+        main, other = self.songbook.create([{
+                    'name': 'Main',
+                    }, {
+                    'name': 'Other',
+                    }])
+        sound_choice, zoom = self.publisher.create([{
+                    'code': 'SC',
+                    'name': 'Sound Choice',
+                    }, {
+                    'code': 'ZM',
+                    'name': 'Zoom',
+                    }])
+        beatles, abba, cher, lennon = self.artist.create([{
+                    'last_name': 'Beatles',
+                    'first_name': 'The',
+                    }, {
+                    'last_name': 'ABBA',
+                    }, {
+                    'last_name': 'Cher',
+                    }, {
+                    'last_name': 'Lennon',
+                    'first_name': 'John',
+                    }])
+        yesterday, help_, sos, believe, imagine = self.song.create([{
+                    'title': 'Yesterday',
+                    'artist': beatles.id,
+                    }, {
+                    'title': 'Help',
+                    'artist': beatles.id,
+                    }, {
+                    'title': 'SOS',
+                    'artist': abba.id,
+                    }, {
+                    'title': 'Believe',
+                    'artist': cher.id,
+                    }, {
+                    'title': 'Imagine',
+                    'artist': lennon.id,
+                    }])
+        hits1, hits2, other_hits1 = self.album.create([{
+                    'songbook': main.id,
+                    'code': 'SC1001',
+                    'name': 'Hits 1',
+                    'publisher': sound_choice.id,
+                    }, {
+                    'songbook': main.id,
+                    'code': 'ZM2002',
+                    'name': 'Hits 2',
+                    'publisher': zoom.id,
+                    }, {
+                    'songbook': other.id,
+                    'code': 'SC1001',
+                    'name': 'Hits 1',
+                    'publisher': sound_choice.id,
+                    }])
+        self.track.create([
+                {'album': hits1.id, 'code': 'SC1001-01', 'song': yesterday.id},
+                {'album': hits1.id, 'code': 'SC1001-02', 'song': sos.id},
+                {'album': hits1.id, 'code': 'SC1001-03', 'song': believe.id},
+                {'album': hits2.id, 'code': 'ZM2002-01', 'song': yesterday.id},
+                {'album': hits2.id, 'code': 'ZM2002-02', 'song': help_.id},
+                {'album': hits2.id, 'code': 'ZM2002-03', 'song': imagine.id},
+                {'album': other_hits1.id, 'code': 'SC1001-01',
+                    'song': imagine.id},
+                ])
+        return main, other
+
+    def delta(self, songbooks, confirm=True):
+        '''
+        Return the lines of a delta export of the songbooks.
+        '''
+        watermarks = self.export_tracks.delta_watermarks(
+            [s.id for s in songbooks])
+        file_ = StringIO()
+        if not self.export_tracks.write_delta(file_, watermarks):
+            return []
+        if confirm:
+            self.export_tracks.confirm_delta(watermarks)
+        return file_.getvalue().split('\r\n')
+
+    def import_(self, songbook, data, format_='jukebox'):
+        '''
+        Import data into the songbook and return the (created, matched,
+        rejected) counts.
+        '''
+        with Transaction().set_context(active_model='songbook.songbook',
+                active_id=songbook.id):
+            session_id, _, _ = self.import_tracks.create()
+            wizard = self.import_tracks(session_id)
+            wizard.start.songbook = songbook
+            wizard.start.file = buffer(data)
+            wizard.start.format = format_
+            wizard.start.album_separator = '-'
+            wizard.start.name_split = 'last'
+            wizard.transition_import_()
+            return (wizard.result.created, wizard.result.matched,
+                wizard.result.rejected)
+
+    def counts(self):
+        return tuple(Model.search([], count=True)
+            for Model in (self.track, self.song, self.artist, self.album))
+
+    def test0005views(self):
+        '''
+        Test views.
+        '''
+        test_view('songbook')
+
+    def test0006depends(self):
+        '''
+        Test depends.
+        '''
+        test_depends()
+
+    def test0010statistics(self):
+        '''
+        Test statistics kept up to date by the catalog.
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            main, other = self.create_songbooks()
+            self.assertEqual([(s.name, s.album_count, s.track_count,
+                        s.song_count, s.artist_count)
+                    for s in self.songbook.browse([main.id, other.id])],
+                [('Main', 2, 6, 5, 4), ('Other', 1, 1, 1, 1)])
+            self.assertEqual(self.catalog.check_statistics(), [])
+
+            cher, = self.artist.search([('last_name', '=', 'Cher')])
+            help_, = self.song.search([('title', '=', 'Help')])
+            self.song.write([help_], {'artist': cher.id})
+            self.assertEqual(self.catalog.check_statistics(), [])
+
+            hits2, = self.album.search([('code', '=', 'ZM2002')])
+            self.album.write([hits2], {'songbook': other.id})
+            self.assertEqual(self.catalog.check_statistics(), [])
+            self.assertEqual([(s['album_count'], s['track_count'])
+                    for s in self.songbook.read([main.id, other.id],
+                        ['album_count', 'track_count'])],
+                [(1, 3), (2, 4)])
+
+            tracks = self.track.search([('code', '=', 'SC1001-02')])
+            self.track.delete(tracks)
+            self.assertEqual(self.catalog.check_statistics(), [])
+            cher, = self.artist.read([cher.id],
+                ['track_count', 'song_count'])
+            self.assertEqual((cher['track_count'], cher['song_count']),
+                (2, 2))
+
+            self.catalog.rebuild()
+            self.assertEqual(self.catalog.check_statistics(), [])
+
+    def test0015statistics_check(self):
+        '''
+        Test the check and the rebuild of wrong statistics.
+        '''
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            self.create_songbooks()
+            transaction.cursor.execute(
+                'UPDATE songbook_songbook SET track_count = 99')
+            self.assertEqual(len(self.catalog.check_statistics()), 2)
+            self.catalog.rebuild_statistics()
+            self.assertEqual(self.catalog.check_statistics(), [])
+
+    def test0020delta_export(self):
+        '''
+        Test delta export of the changes since the last confirmed one.
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            main, other = self.create_songbooks()
+            self.assertEqual(self.delta([main]), [
+                    'A|SC1001-01|Yesterday .SC.|The Beatles',
+                    'A|SC1001-02|SOS .SC.| ABBA',
+                    'A|SC1001-03|Believe .SC.| Cher',
+                    'A|ZM2002-01|Yesterday .ZM.|The Beatles',
+                    'A|ZM2002-02|Help .ZM.|The Beatles',
+                    'A|ZM2002-03|Imagine .ZM.|John Lennon',
+                    ])
+            self.assertEqual(self.delta([main]), [])
+
+            help_, = self.song.search([('title', '=', 'Help')])
+            self.song.write([help_], {'title': 'Help!'})
+            hits1, = self.album.search([
+                    ('code', '=', 'SC1001'),
+                    ('songbook', '=', main.id),
+                    ])
+            self.track.create([{
+                        'album': hits1.id,
+                        'code': 'SC1001-04',
+                        'song': help_.id,
+                        }])
+            self.track.delete(self.track.search([
+                        ('code', '=', 'SC1001-02'),
+                        ('album', '=', hits1.id),
+                        ]))
+            self.track.write(self.track.search([
+                        ('code', '=', 'SC1001-03'),
+                        ('album', '=', hits1.id),
+                        ]), {'code': 'SC1001-09'})
+            changes = [
+                'D|SC1001-02||',
+                'D|SC1001-03||',
+                'A|SC1001-04|Help! .SC.|The Beatles',
+                'U|SC1001-09|Believe .SC.| Cher',
+                'U|ZM2002-02|Help! .ZM.|The Beatles',
+                ]
+            # Not confirmed, so exported again
+            self.assertEqual(self.delta([main], confirm=False), changes)
+            self.assertEqual(self.delta([main]), changes)
+            self.assertEqual(self.delta([main]), [])
+
+            hits2, = self.album.search([('code', '=', 'ZM2002')])
+            self.album.write([hits2], {'songbook': other.id})
+            self.assertEqual(self.delta([main]), [
+                    'D|ZM2002-01||',
+                    'D|ZM2002-02||',
+                    'D|ZM2002-03||',
+                    ])
+            self.assertEqual(self.delta([other]), [
+                    'A|SC1001-01|Imagine .SC.|John Lennon',
+                    'A|ZM2002-01|Yesterday .ZM.|The Beatles',
+                    'A|ZM2002-02|Help! .ZM.|The Beatles',
+                    'A|ZM2002-03|Imagine .ZM.|John Lennon',
+                    ])
+
+    def test0030import(self):
+        '''
+        Test import of the full export and of CSV files.
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            main, other = self.create_songbooks()
+            file_ = StringIO()
+            self.export_tracks.write_tracks(file_, [main.id])
+            data = file_.getvalue()
+
+            counts = self.counts()
+            self.assertEqual(self.import_(main, data), (0, 6, 0))
+            self.assertEqual(self.counts(), counts)
+
+            # SC1001-01 is already another song in this songbook
+            self.assertEqual(self.import_(other, data), (5, 0, 1))
+            counts = self.counts()
+            self.assertEqual(self.import_(other, data), (0, 5, 1))
+            self.assertEqual(self.counts(), counts)
+
+            self.assertEqual(self.import_(main, 'XX1-01|No publisher|Foo\r\n'
+                    'NEW1-01|Brand New .NP.|Jane Doe\r\n'), (1, 0, 1))
+
+            data = (u'code,title,publisher,artist_last_name,'
+                'artist_first_name,album,album_name\n'
+                u'CSV-01,\xc7a va,CS,Doe,Jane,CSV,Csv Album\n'
+                u'CSV-02,Second,CS,Lone,,CSV,\n').encode('utf-8')
+            self.assertEqual(self.import_(main, data, 'csv'), (2, 0, 0))
+            counts = self.counts()
+            self.assertEqual(self.import_(main, data, 'csv'), (0, 2, 0))
+            self.assertEqual(self.counts(), counts)
+            track, = self.track.search([('code', '=', 'CSV-01')])
+            self.assertEqual((track.song.title, track.song.artist.full_name),
+                (u'\xc7a va', 'Jane Doe'))
+
+            lines = sorted(c.line for c in self.catalog.search([]))
+            self.catalog.rebuild()
+            self.assertEqual(sorted(c.line for c in self.catalog.search([])),
+                lines)
+
+    def test0040lookup(self):
+        '''
+        Test the track code index.
+        '''
+        rows = [
+            (u'B-01', u'Caf\xe9', u'Artist 1'),
+            (u'A-01', u'First', None),
+            (u'B-01', u'Again', u'Artist 2'),
+            (u'C-01', u'', u'Artist 3'),
+            ]
+        file_ = StringIO()
+        self.assertEqual(TrackIndex.write(file_, iter(rows)), 4)
+        index = TrackIndex(file_.getvalue())
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.lookup(u'A-01'), [(u'First', u'')])
+        self.assertEqual(index.lookup(u'B-01'),
+            [(u'Caf\xe9', u'Artist 1'), (u'Again', u'Artist 2')])
+        self.assertEqual(index.lookup(u'C-01'), [(u'', u'Artist 3')])
+        for code in (u'', u'A', u'B-02', u'Z-01'):
+            self.assertEqual(index.lookup(code), [])
+
+        self.assertRaises(ValueError, TrackIndex, 'SBKY' + file_.getvalue()[4:])
+
+        max_ = lookup._MAX
+        lookup._MAX = 20
+        try:
+            file_ = StringIO()
+            self.assertRaises(ValueError, TrackIndex.write, file_,
+                iter(rows))
+            self.assertEqual(file_.getvalue(), '')
+        finally:
+            lookup._MAX = max_
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            main, other = self.create_songbooks()
+            with NamedTemporaryFile() as file_:
+                self.assertEqual(self.export_tracks.write_index(file_,
+                        [main.id, other.id]), 7)
+                file_.flush()
+                index = TrackIndex.open(file_.name)
+                self.assertEqual(index.lookup(u'SC1001-01'), [
+                        (u'Yesterday', u'The Beatles'),
+                        (u'Imagine', u'John Lennon'),
+                        ])
+                self.assertEqual(index.lookup(u'ZM2002-02'),
+                    [(u'Help', u'The Beatles')])
+
+    def test0050explain(self):
+        '''
+        Test that the export and report queries use indexes.
+        '''
+        parameters = dict(DEFAULTS, albums=20, tracks=10, artists=100,
+            songs=300)
+        with catalog(parameters) as (_, _, context):
+            # Only the songbooks and publishers may be scanned
+            self.assertEqual(check(context, 50), [])
+
+
+def suite():
+    suite = trytond.tests.test_tryton.suite()
+    suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
+            SongbookTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
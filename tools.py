@@ -0,0 +1,154 @@
+import datetime
+import re
+import unicodedata
+
+from sql.conditionals import Case
+from sql.operators import In
+
+from trytond.config import CONFIG
+from nereid import url_for, request, abort
+
+__all__ = ['create_trigram_index', 'update_column', 'url_template',
+    'to_datetime', 'sort_key', 'api_limit', 'api_ids', 'api_fields',
+    'project']
+
+_URL_SENTINEL = 987654321
+_SORT_SEPARATORS = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def create_trigram_index(cursor, table_name, column_name):
+    """
+    Create a trigram GIN index on the column so that ILIKE '%...%'
+    searches can use it on PostgreSQL.
+    Nothing is done on other backends or when the pg_trgm extension can
+    not be installed by the database user.
+    """
+    if CONFIG['db_type'] != 'postgresql':
+        return
+    index_name = '%s_%s_trgm_index' % (table_name, column_name)
+    cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s',
+        (index_name,))
+    if cursor.fetchone():
+        return
+    cursor.execute('SELECT 1 FROM pg_extension WHERE extname = %s',
+        ('pg_trgm',))
+    if not cursor.fetchone():
+        cursor.execute('SAVEPOINT songbook_pg_trgm')
+        try:
+            cursor.execute('CREATE EXTENSION pg_trgm')
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT songbook_pg_trgm')
+            return
+        finally:
+            cursor.execute('RELEASE SAVEPOINT songbook_pg_trgm')
+    cursor.execute('CREATE INDEX "%s" ON "%s" USING gin ("%s" gin_trgm_ops)'
+        % (index_name, table_name, column_name))
+
+
+def update_column(cursor, table, column, values):
+    """
+    Set the column of the rows of table to the values by id, with one
+    UPDATE per batch of rows instead of one per row.
+    """
+    ids = values.keys()
+    # The id and the value of the CASE and the id of the IN per row
+    batch = max(1, cursor.IN_MAX // 3)
+    for i in range(0, len(ids), batch):
+        sub_ids = ids[i:i + batch]
+        cursor.execute(*table.update([column],
+                [Case(*[(table.id == id_, values[id_]) for id_ in sub_ids])],
+                where=In(table.id, sub_ids)))
+
+
+def url_template(endpoint, **values):
+    """
+    Return the url of endpoint as a template to be formatted with a
+    record id, so that many urls can be built with a single url_for call.
+    """
+    url = url_for(endpoint, id=_URL_SENTINEL, **values)
+    return url.replace('%', '%%').replace(str(_URL_SENTINEL), '%d')
+
+
+def api_limit(default):
+    """
+    Return the limit argument of the request, default when it is missing
+    or invalid, capped to the songbook_api_limit option.
+    """
+    maximum = int(CONFIG.get('songbook_api_limit', 100))
+    limit = request.args.get('limit', default, int)
+    return max(1, min(limit, maximum))
+
+
+def api_ids(name='ids'):
+    """
+    Return the ids of the comma-separated name argument of the request,
+    capped like the limit, or None when it is missing.
+    """
+    if name not in request.args:
+        return None
+    try:
+        ids = [int(i) for i in request.args[name].split(',') if i.strip()]
+    except ValueError:
+        abort(400)
+    return ids[:int(CONFIG.get('songbook_api_limit', 100))]
+
+
+def api_fields(available):
+    """
+    Return the names of the comma-separated fields argument of the request,
+    None when it is missing. Abort when one is not in available.
+    """
+    if 'fields' not in request.args:
+        return None
+    fields = [f.strip() for f in request.args['fields'].split(',')
+        if f.strip()]
+    if set(fields) - set(available):
+        abort(400)
+    return fields
+
+
+def project(payload, fields):
+    "Return the payload with only objectType, id and fields (all if None)"
+    if fields is None:
+        return payload
+    return dict((k, v) for k, v in payload.iteritems()
+        if k in fields or k in ('objectType', 'id'))
+
+
+def to_datetime(value):
+    """
+    Return value as a datetime.
+    Aggregates of timestamp columns come back as strings from SQLite.
+    A date alone is taken at midnight.
+    """
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    if ' ' not in value:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    if '.' in value:
+        return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f')
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+def sort_key(text):
+    """
+    Return the key ordering text in the listings: punctuation is replaced
+    by spaces and, depending on the options, the case is folded
+    (songbook_sort_fold_case), the diacritics are removed
+    (songbook_sort_strip_diacritics) and a leading article is dropped
+    (songbook_sort_articles, the space-separated list of articles).
+    """
+    if not text:
+        return u''
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8')
+    if CONFIG.get('songbook_sort_fold_case', True):
+        text = text.lower()
+    if CONFIG.get('songbook_sort_strip_diacritics', True):
+        text = u''.join(c for c in unicodedata.normalize('NFKD', text)
+            if not unicodedata.combining(c))
+    articles = CONFIG.get('songbook_sort_articles', 'the a an') or ''
+    words = text.split(None, 1)
+    if len(words) == 2 and words[0].lower() in articles.lower().split():
+        text = words[1]
+    return _SORT_SEPARATORS.sub(u' ', text).strip()
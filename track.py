@@ -7,6 +7,10 @@ from nereid import (
 from nereid.contrib.pagination import Pagination, BasePagination
 from nereid.ctx import has_request_context
 
+from .lookup import TrackIndex
+from .profiling import profiled
+from .responsecache import response_cache
+
 __all__ = ['Track']
 
 
@@ -14,9 +18,11 @@ class Track(ModelSQL, ModelView):
     "Track"
     __name__ = "songbook.track"
 
-    album = fields.Many2One("songbook.album", 'Album', required=True)
+    album = fields.Many2One("songbook.album", 'Album', required=True,
+        select=True)
     code = fields.Char('Code', 16, required=True, select=True)
-    song = fields.Many2One("songbook.song", 'Song', required=True)
+    song = fields.Many2One("songbook.song", 'Song', required=True,
+        select=True)
 
     @classmethod
     def __setup__(cls):
@@ -27,4 +33,47 @@ class Track(ModelSQL, ModelView):
         ]
         cls._order.insert(0, ('code', 'ASC'))
 
+    @classmethod
+    def create(cls, vlist):
+        Catalog = Pool().get('songbook.catalog')
+        tracks = super(Track, cls).create(vlist)
+        Catalog.refresh([t.id for t in tracks])
+        response_cache.clear()
+        return tracks
+
+    @classmethod
+    def write(cls, tracks, values):
+        Catalog = Pool().get('songbook.catalog')
+        super(Track, cls).write(tracks, values)
+        Catalog.refresh([t.id for t in tracks])
+        response_cache.clear()
 
+    @classmethod
+    def delete(cls, tracks):
+        Catalog = Pool().get('songbook.catalog')
+        Catalog.forget([t.id for t in tracks])
+        super(Track, cls).delete(tracks)
+        response_cache.clear()
+
+    @classmethod
+    @route('/songbook/lookup/<code>', methods=['GET'])
+    @profiled
+    def call_api_lookup(cls, code):
+        """
+        JSON-formatted title and artist of the tracks with the code, read
+        from the track code index set by songbook_lookup_index without
+        querying the database.
+        """
+        index = TrackIndex.served()
+        if index is None:
+            abort(404)
+        tracks = index.lookup(code)
+        if not tracks:
+            abort(404)
+        return jsonify(
+            code=code,
+            tracks=[{
+                    'title': title,
+                    'artist': artist,
+                    } for title, artist in tracks]
+        )